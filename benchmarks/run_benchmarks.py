@@ -0,0 +1,200 @@
+"""
+Benchmarks of the download functions against a local stand-in db.
+
+Usage: python benchmarks/run_benchmarks.py [--url mongodb://127.0.0.1:27017] [--days 1095] [--compare]
+
+Without --url the data are loaded into mongomock. Every run appends one json line per benchmark
+to benchmarks/results.jsonl, tagged with the git revision, so regressions are visible between versions.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import depuration
+import plotting_utils
+from synthetic_data import GROUP_ID, STRUCTURE_ID, generateFdd, generateTemperatures, loadStandIn, standInClient
+
+RESULTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results.jsonl")
+
+
+def gitRevision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)), text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Phases:
+    """Time and peak memory of the phases of a benchmark"""
+
+    def __init__(self):
+        self.results = {}
+
+    def run(self, name, func, *args, **kwargs):
+        tracemalloc.start()
+        t0 = time.perf_counter()
+        out = func(*args, **kwargs)
+        elapsed = time.perf_counter() - t0
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        self.results[name] = {"seconds": elapsed, "peak_bytes": peak}
+        return out
+
+
+def fetchPhases(phases, coll, query, pipeline=None, name="query"):
+    """
+    Query (server + transfer) and decode phases; they can only be split on a real mongod
+
+    :param pipeline: run this aggregation pipeline instead of a find of query
+    :param name: name of the query phase (the decode phase is name + "_decode", or "decode" for the query)
+    """
+    decode = "decode" if name == "query" else name + "_decode"
+    try:
+        if pipeline is None:
+            raw = phases.run(name, lambda: list(coll.find_raw_batches(query).sort("date", 1)))
+        else:
+            raw = phases.run(name, lambda: list(coll.aggregate_raw_batches(pipeline)))
+    except (AttributeError, NotImplementedError):
+        if pipeline is None:
+            return phases.run(name, lambda: list(coll.find(query).sort("date", 1)))
+        return phases.run(name, lambda: list(coll.aggregate(pipeline)))
+    import bson
+    return phases.run(decode, lambda: [doc for batch in raw for doc in bson.decode_all(batch)])
+
+
+def benchTraces(db, coll_name, sensorType, axis):
+    phases = Phases()
+    query = plotting_utils._FddQuery(STRUCTURE_ID, GROUP_ID, sensorType, axis)
+    fdd = fetchPhases(phases, db[coll_name], query)
+    # DownloadTraces does not collect the shapes
+    ftraces, _, _ = phases.run("regroup", plotting_utils._GroupTraces, fdd, sensorType, shapes=False)
+    phases.run("aggregate", lambda: [np.mean(ftraces[key]) for key in ftraces.keys() if key != -1])
+    phases.run("total", plotting_utils.DownloadTraces, db.client, db.name, coll_name,
+               STRUCTURE_ID, GROUP_ID, sensorType, axis)
+    return phases.results
+
+
+def benchInitializationTraces(db, coll_name, sensorType, axis, initialization_days, num_sensori):
+    phases = Phases()
+    query = plotting_utils._FddQuery(STRUCTURE_ID, GROUP_ID, sensorType, axis)
+    fdd = fetchPhases(phases, db[coll_name], query)
+    blocks = phases.run("select", lambda: list(plotting_utils._InitializationBlocks(
+        fdd, sensorType, initialization_days, num_sensori)))
+    ftraces, modalshapetraces, _ = phases.run("regroup", plotting_utils._GroupTraces, blocks, sensorType)
+    phases.run("aggregate", plotting_utils._ClusterMeans, ftraces, modalshapetraces, sensorType)
+    phases.run("total", plotting_utils.DownloadInitializationTraces, db.client, db.name, STRUCTURE_ID, GROUP_ID,
+               sensorType, axis, initialization_days, num_sensori, 'prod', coll_name)
+    return phases.results
+
+
+def benchPeakVector(db, coll_name, sensorType, axis, initialization_days, num_sensori):
+    phases = Phases()
+    query = plotting_utils._FddQuery(STRUCTURE_ID, GROUP_ID, sensorType, axis)
+    fdd = fetchPhases(phases, db[coll_name], query)
+    phases.run("regroup", lambda: list(plotting_utils._PeakRecords(plotting_utils._PeakBlocks(
+        fdd, sensorType, num_sensori, True, initialization_days), sensorType)))
+    for track in (False, True):
+        phases.run(f"total_track_{track}", plotting_utils.DownloadPeakVector, db.client, db.name, STRUCTURE_ID,
+                   GROUP_ID, sensorType, axis, num_sensori, track, initialization_days, 'prod', coll_name)
+    return phases.results
+
+
+def benchTemperatures(db):
+    """
+    query/decode: the raw temperature documents; aggregate/aggregate_decode: the server side daily
+    aggregation of DownloadTemperatures; regroup: its conversion to the output lists
+    """
+    phases = Phases()
+    fetchPhases(phases, db["temperatures"], {})
+    tmps = fetchPhases(phases, db["temperatures"], None, depuration._DailyTemperaturePipeline({}), name="aggregate")
+    phases.run("regroup", depuration._DailyTemperatures, tmps)
+    phases.run("total", depuration.DownloadTemperatures, db.client, db.name)
+    return phases.results
+
+
+def compareLast(path=RESULTS):
+    """Print the change of every phase between the last two runs of every benchmark"""
+    runs = {}
+    with open(path) as f:
+        for line in f:
+            record = json.loads(line)
+            runs.setdefault((record["benchmark"], json.dumps(record["params"], sort_keys=True)), []).append(record)
+    for (name, params), records in sorted(runs.items()):
+        if len(records) < 2:
+            continue
+        old, new = records[-2], records[-1]
+        print(f"{name} {params} ({old['revision']} -> {new['revision']})")
+        for phase, values in new["phases"].items():
+            if phase in old["phases"]:
+                before = old["phases"][phase]["seconds"]
+                ratio = values["seconds"] / before if before else float("nan")
+                print(f"  {phase:<20} {before:10.4f}s -> {values['seconds']:10.4f}s  x{ratio:.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default=None, help="local mongod url (default: mongomock)")
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--labels", type=int, default=6)
+    parser.add_argument("--outlier-ratio", type=float, default=0.1)
+    parser.add_argument("--dropout-ratio", type=float, default=0.05)
+    parser.add_argument("--sensor-types", type=int, nargs="+", default=[1, 2, 3, 4])
+    parser.add_argument("--initialization-days", type=int, default=14)
+    parser.add_argument("--num-sensori", type=int, default=8)
+    parser.add_argument("--output", default=RESULTS)
+    parser.add_argument("--compare", action="store_true", help="only compare the last two saved runs")
+    args = parser.parse_args()
+
+    if args.compare:
+        compareLast(args.output)
+        return
+
+    client = standInClient(args.url)
+    revision = gitRevision()
+    timestamp = datetime.now().isoformat()
+    records = []
+
+    for sensorType in args.sensor_types:
+        axis = "X" if sensorType in [2, 3] else None
+        params = {"days": args.days, "labels": args.labels, "outlier_ratio": args.outlier_ratio,
+                  "num_sensori": args.num_sensori, "dropout_ratio": args.dropout_ratio, "sensorType": sensorType}
+        fdd = generateFdd(days=args.days, labels=args.labels, outlier_ratio=args.outlier_ratio,
+                          dropout_ratio=args.dropout_ratio, sensorType=sensorType,
+                          axis=axis or "X", num_sensori=args.num_sensori)
+        db = loadStandIn(client, fdd=fdd)
+
+        benches = {
+            "DownloadTraces": lambda: benchTraces(db, "fdd", sensorType, axis),
+            "DownloadInitializationTraces": lambda: benchInitializationTraces(
+                db, "fdd", sensorType, axis, args.initialization_days, args.num_sensori),
+            "DownloadPeakVector": lambda: benchPeakVector(
+                db, "fdd", sensorType, axis, args.initialization_days, args.num_sensori),
+        }
+        for name, bench in benches.items():
+            records.append({"benchmark": name, "params": params, "phases": bench()})
+
+    db = loadStandIn(client, temperatures=generateTemperatures(days=args.days))
+    records.append({"benchmark": "DownloadTemperatures", "params": {"days": args.days},
+                    "phases": benchTemperatures(db)})
+
+    with open(args.output, "a") as f:
+        for record in records:
+            record.update(revision=revision, timestamp=timestamp, backend=args.url or "mongomock")
+            f.write(json.dumps(record) + "\n")
+            total = {phase: f"{values['seconds']:.4f}s" for phase, values in record["phases"].items()}
+            print(record["benchmark"], record["params"].get("sensorType", ""), total)
+
+
+if __name__ == "__main__":
+    main()
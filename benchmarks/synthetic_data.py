@@ -0,0 +1,108 @@
+"""Generator of synthetic fdd and temperature documents for the benchmarks."""
+
+import random
+from datetime import datetime, timedelta
+
+from bson.objectid import ObjectId
+
+SWITCHER = {
+        1: "deck",
+        2: "accelerometerComplete",
+        3: "accelerometerComplete",
+        4: "deckShort1600"
+    }
+
+STRUCTURE_ID = ObjectId("6183ec3f5c580e131f45ac37")
+GROUP_ID = ObjectId("62e252a3b694b0ac5818c0e5")
+
+
+def generateFdd(days=365, labels=6, outlier_ratio=0.1, dropout_ratio=0.05,
+                sensorType=3, axis="X", num_sensori=8, seed=0, start=datetime(2021, 1, 1)):
+    """
+    Generate one fdd document per day for a group
+
+    :param labels: number of modal traces (labels 0..labels-1)
+    :param outlier_ratio: fraction of traces labelled -1
+    :param dropout_ratio: fraction of days with one sensor missing from EUIorder (and ShapeEUIorder)
+    :param num_sensori: number of sensors; every shape_value / modalshapeVector row has one component
+        per EUI of its day, so the dropout days have shorter shapes
+    :param sensorType: 1 to 4, as returned by db_utils.findSensorType
+    """
+    rng = random.Random(seed)
+    euis = [f"0080E1150000{i:04X}" for i in range(num_sensori)]
+    base_freqs = [1.0 + 2.5 * label for label in range(labels)]
+
+    docs = []
+    for day in range(days):
+        day_euis = list(euis)
+        if rng.random() < dropout_ratio:
+            day_euis.pop(rng.randrange(len(day_euis)))
+
+        traces = []
+        for label, base in enumerate(base_freqs):
+            trace = {"label": label, "freq_value": base * (1 + rng.gauss(0, 0.01))}
+            if sensorType == 3:
+                trace["shape_value"] = [rng.uniform(-1, 1) for _ in day_euis]
+            traces.append(trace)
+        n_outliers = int(round(labels * outlier_ratio / max(1 - outlier_ratio, 1e-9)))
+        for _ in range(n_outliers):
+            trace = {"label": -1, "freq_value": rng.uniform(0.5, base_freqs[-1] * 1.2)}
+            if sensorType == 3:
+                trace["shape_value"] = [rng.uniform(-1, 1) for _ in day_euis]
+            traces.append(trace)
+
+        doc = {
+            "structureID": STRUCTURE_ID,
+            "group": GROUP_ID,
+            "type": SWITCHER[sensorType],
+            "date": start + timedelta(days=day),
+            "traces": traces,
+            "EUIorder": day_euis,
+            "freqVector": sorted(rng.uniform(0.5, 50) for _ in range(rng.randint(10, 30))),
+            "TotalTime": rng.uniform(0, 86400),
+        }
+        if sensorType in [2, 3]:
+            doc["axis"] = axis.upper()
+        if sensorType == 3:
+            doc["ShapeEUIorder"] = day_euis
+            doc["modalshapeVector"] = [[rng.uniform(-1, 1) for _ in day_euis] for _ in doc["freqVector"]]
+            doc["fSample"] = 100.0
+        docs.append(doc)
+    return docs
+
+
+def generateTemperatures(days=365, euis=("0080E11500289CDE",), per_day=24, seed=0, start=datetime(2021, 1, 1)):
+    """Generate per_day temperature readings per day and eui"""
+    rng = random.Random(seed)
+    step = timedelta(seconds=86400 / per_day)
+    docs = []
+    for day in range(days):
+        for eui in euis:
+            for i in range(per_day):
+                docs.append({
+                    "eui": eui,
+                    "date": start + timedelta(days=day) + i * step,
+                    "temperature": 15 + 10 * rng.random(),
+                })
+    return docs
+
+
+def standInClient(url=None):
+    """Client of a local mongod if url is given, of an in-memory mongomock db otherwise"""
+    if url:
+        from pymongo import MongoClient
+        return MongoClient(url)
+    import mongomock
+    return mongomock.MongoClient()
+
+
+def loadStandIn(client, db_name="bench", coll_name="fdd", fdd=(), temperatures=()):
+    """Replace the fdd and temperatures collections of db_name with the given documents"""
+    db = client[db_name]
+    db.drop_collection(coll_name)
+    db.drop_collection("temperatures")
+    if fdd:
+        db[coll_name].insert_many([dict(doc) for doc in fdd])
+    if temperatures:
+        db["temperatures"].insert_many([dict(doc) for doc in temperatures])
+    return db
@@ -0,0 +1,157 @@
+"""Module to decode fdd array fields from raw BSON straight into NumPy arrays."""
+
+import struct
+
+import bson
+import numpy as np
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+
+RAW_OPTIONS = CodecOptions(document_class=RawBSONDocument)
+
+_INT32 = struct.Struct("<i")
+_DOUBLE = struct.Struct("<d")
+_INT64 = struct.Struct("<q")
+
+# size of the fixed-length BSON values, by element type
+_FIXED_SIZES = {0x01: 8, 0x06: 0, 0x07: 12, 0x08: 1, 0x09: 8, 0x0A: 0, 0x10: 4, 0x11: 8, 0x12: 8, 0x13: 16,
+                0xFF: 0, 0x7F: 0}
+
+
+def _elements(buf, off):
+    """Yield (type, name, value offset, value end) of the elements of the BSON document at off"""
+    end = off + _INT32.unpack_from(buf, off)[0] - 1
+    pos = off + 4
+    while pos < end:
+        etype = buf[pos]
+        name_end = buf.index(b"\x00", pos + 1)
+        name = buf[pos + 1:name_end].decode()
+        value = name_end + 1
+        if etype in _FIXED_SIZES:
+            value_end = value + _FIXED_SIZES[etype]
+        elif etype in (0x02, 0x0D, 0x0E):
+            value_end = value + 4 + _INT32.unpack_from(buf, value)[0]
+        elif etype in (0x03, 0x04, 0x0F):
+            value_end = value + _INT32.unpack_from(buf, value)[0]
+        elif etype == 0x05:
+            value_end = value + 5 + _INT32.unpack_from(buf, value)[0]
+        elif etype == 0x0B:
+            value_end = buf.index(b"\x00", buf.index(b"\x00", value) + 1) + 1
+        elif etype == 0x0C:
+            value_end = value + 4 + _INT32.unpack_from(buf, value)[0] + 12
+        else:
+            raise ValueError(f"Unknown BSON element type {etype:#x}")
+        yield etype, name, value, value_end
+        pos = value_end
+
+
+def _keyDigits(n):
+    """Number of characters of the array keys '0', '1', ..., str(n-1)"""
+    i = np.arange(n)
+    digits = np.ones(n, dtype=np.int64)
+    power = 10
+    while power <= max(n - 1, 0):
+        digits += i >= power
+        power *= 10
+    return digits
+
+
+def doubleArray(buf, off):
+    """
+    Decode the BSON array at off into a float64 array
+
+    Arrays made only of doubles (the usual case for freqVector) are read with a single vectorized
+    gather; arrays with integers or other types fall back to the bson decoder.
+    """
+    size = _INT32.unpack_from(buf, off)[0]
+    body = size - 5
+    if body == 0:
+        return np.empty(0)
+
+    max_n = body // 10 + 1
+    digits = _keyDigits(max_n)
+    element_sizes = 10 + digits  # type byte + key + NUL + 8 bytes
+    ends = np.cumsum(element_sizes)
+    n = int(np.searchsorted(ends, body)) + 1
+    if n <= max_n and ends[n - 1] == body:
+        starts = off + 4 + ends[:n] - element_sizes[:n]
+        data = np.frombuffer(buf, dtype=np.uint8)
+        if np.all(data[starts] == 0x01):
+            value_offsets = starts + 2 + digits[:n]
+            return data[value_offsets[:, None] + np.arange(8)].copy().view("<f8").ravel()
+
+    values = bson.decode(bytes(buf[off:off + size]), codec_options=CodecOptions()).values()
+    return np.fromiter(values, dtype=np.float64)
+
+
+def _arrayOfArrays(buf, off):
+    """Decode a BSON array of numeric arrays into a list of float64 arrays"""
+    return [doubleArray(buf, value) for etype, _, value, _ in _elements(buf, off) if etype == 0x04]
+
+
+def _scalar(buf, etype, value, value_end):
+    if etype == 0x01:
+        return _DOUBLE.unpack_from(buf, value)[0]
+    if etype == 0x10:
+        return _INT32.unpack_from(buf, value)[0]
+    if etype in (0x09, 0x12):
+        return _INT64.unpack_from(buf, value)[0]
+    if etype == 0x0A:
+        return None
+    # anything else (strings, sub documents, ...) through the bson decoder
+    wrapper = b"\x00" * 4 + bytes([etype]) + b"v\x00" + bytes(buf[value:value_end]) + b"\x00"
+    wrapper = _INT32.pack(len(wrapper)) + wrapper[4:]
+    return bson.decode(wrapper)["v"]
+
+
+class RawFdd:
+    """
+    Lightweight view of a raw fdd document
+
+    Small fields are decoded eagerly, array fields (freqVector, modalshapeVector) only on request.
+    Supports the item access used by the peak selection helpers.
+    """
+
+    ARRAYS = ("freqVector", "modalshapeVector")
+
+    def __init__(self, raw):
+        self.raw = raw
+        self._fields = {}
+        self._arrays = {}
+        for etype, name, value, value_end in _elements(raw, 0):
+            if name in self.ARRAYS:
+                self._arrays[name] = value
+            elif name == "date" and etype == 0x09:
+                self._fields[name] = np.datetime64(_INT64.unpack_from(raw, value)[0], "ms")
+            elif name != "traces":
+                self._fields[name] = _scalar(raw, etype, value, value_end)
+
+    def __getitem__(self, name):
+        if name == "freqVector":
+            return doubleArray(self.raw, self._arrays[name])
+        if name == "modalshapeVector":
+            return _arrayOfArrays(self.raw, self._arrays[name])
+        return self._fields[name]
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+
+def raggedShapes(days):
+    """
+    Pack the modalshapeVector of many days
+
+    :param days: list (one item per day) of lists of 1-D arrays (one per frequency)
+    :return: flat float64 values, row_offsets (values of row r are values[row_offsets[r]:row_offsets[r+1]]),
+        day_offsets (rows of day d are day_offsets[d]:day_offsets[d+1])
+    """
+    rows = [np.asarray(row, dtype=np.float64) for day in days for row in day]
+    row_offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+    row_offsets[1:] = np.cumsum(np.fromiter((r.shape[0] for r in rows), dtype=np.int64, count=len(rows)))
+    day_offsets = np.zeros(len(days) + 1, dtype=np.int64)
+    day_offsets[1:] = np.cumsum(np.fromiter((len(day) for day in days), dtype=np.int64, count=len(days)))
+    values = np.concatenate(rows) if rows else np.empty(0)
+    return values, row_offsets, day_offsets
@@ -0,0 +1,205 @@
+"""Module with a local on-disk cache of the fdd collections."""
+
+import hashlib
+import json
+import os
+from datetime import datetime
+
+import bson
+
+import metrics_utils
+import settings
+
+
+class FddCache:
+    """
+    Persistent cache of fdd documents.
+
+    Every (db, collection, structureID, group, type, axis) key is stored as a file of
+    concatenated BSON documents sorted by date, plus a small json file with the date watermark,
+    the _ids of the documents of that date, the number of documents and the committed byte length
+    of the data file. A refresh downloads the documents from the watermark date onwards and appends
+    the ones not cached yet (a key may have several documents per date, e.g. one per axis); bytes
+    past the committed length (an interrupted append) are truncated first.
+    """
+
+    def __init__(self, cache_dir=None, max_bytes=None):
+        self.cache_dir = cache_dir or settings.CACHE_DIR
+        self.max_bytes = max_bytes if max_bytes is not None else settings.CACHE_MAX_BYTES
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(coll, query):
+        """Cache key of a collection/query pair"""
+        return (
+            coll.database.name,
+            coll.name,
+            str(query.get("structureID")),
+            str(query.get("group")),
+            query.get("type"),
+            query.get("axis"),
+        )
+
+    def _paths(self, key):
+        name = hashlib.sha1(json.dumps([str(k) for k in key]).encode()).hexdigest()
+        base = os.path.join(self.cache_dir, name)
+        return base + ".bson", base + ".json"
+
+    def _readMeta(self, meta_path):
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path) as f:
+            return json.load(f)
+
+    def _readDocs(self, data_path, meta):
+        if not os.path.exists(data_path):
+            return []
+        with open(data_path, "rb") as f:
+            # a partially written append (meta not updated) is past the committed length
+            data = f.read(meta["bytes"]) if "bytes" in meta else f.read()
+        try:
+            docs = bson.decode_all(data)
+        except bson.errors.InvalidBSON:
+            return []
+        return docs[:meta["count"]]
+
+    def load(self, coll, query, refresh=True):
+        """
+        Return the documents matching query sorted by date, using the cache
+
+        :param refresh: if False do not contact the db when the key is already cached
+        """
+        key = self.key(coll, query)
+        data_path, meta_path = self._paths(key)
+        meta = self._readMeta(meta_path)
+
+        docs = self._readDocs(data_path, meta) if meta else []
+        if meta and (len(docs) < meta["count"] or "bytes" not in meta or "watermark_ids" not in meta):
+            # data file truncated, lost or written by an older version: start over
+            docs, meta = [], None
+            if os.path.exists(data_path):
+                os.remove(data_path)
+
+        if meta and not refresh:
+            os.utime(meta_path)
+            metrics_utils.count(cache_hits=len(docs))
+            return docs
+
+        new_query = dict(query)
+        if meta and meta["watermark"]:
+            new_query["date"] = {"$gte": datetime.fromisoformat(meta["watermark"])}
+
+        with metrics_utils.phase("query"):
+            new_docs = list(coll.find(new_query).sort("date", 1))
+        if meta:
+            cached = set(meta["watermark_ids"])
+            new_docs = [doc for doc in new_docs if str(doc["_id"]) not in cached]
+        metrics_utils.count(docs=len(new_docs), cache_hits=len(docs),
+                            payload=new_docs if metrics_utils.enabled() else None)
+
+        if new_docs or not meta:
+            docs.extend(new_docs)
+            last_date = docs[-1]["date"] if docs else None
+            self._write(key, new_docs, last_date, _watermarkIds(docs, last_date), len(docs),
+                        meta["bytes"] if meta else 0)
+        else:
+            os.utime(meta_path)
+
+        return docs
+
+    def _write(self, key, new_docs, last_date, watermark_ids, count, committed):
+        """
+        Write new_docs after the first committed bytes of the data file and move the watermark to last_date
+
+        The meta file is replaced only after the data is written, so an interrupted write leaves
+        the previous watermark, count and length valid.
+        """
+        data_path, meta_path = self._paths(key)
+        with open(data_path, "r+b" if committed and os.path.exists(data_path) else "wb") as f:
+            f.seek(committed)
+            f.truncate()
+            for doc in new_docs:
+                f.write(bson.encode(doc))
+            size = f.tell()
+        watermark = last_date.isoformat() if last_date else None
+        tmp_path = meta_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"key": [str(k) for k in key], "watermark": watermark, "watermark_ids": watermark_ids,
+                       "count": count, "bytes": size}, f)
+        os.replace(tmp_path, meta_path)
+        self.evict()
+
+    def append(self, coll, query, new_docs):
+        """
+        Append documents received by other means (e.g. a change stream) to a cached key
+
+        Only the documents not older than the watermark and not cached yet are kept, so the cache
+        stays sorted by date. A key that is not cached yet is left alone (the next load downloads it whole).
+        """
+        key = self.key(coll, query)
+        meta = self._readMeta(self._paths(key)[1])
+        if meta is None or "bytes" not in meta or "watermark_ids" not in meta:
+            return
+        watermark = datetime.fromisoformat(meta["watermark"]) if meta["watermark"] else None
+        cached = set(meta["watermark_ids"])
+        new_docs = sorted((doc for doc in new_docs if watermark is None or doc["date"] > watermark
+                           or (doc["date"] == watermark and str(doc["_id"]) not in cached)),
+                          key=lambda doc: doc["date"])
+        if not new_docs:
+            return
+        last_date = new_docs[-1]["date"]
+        watermark_ids = _watermarkIds(new_docs, last_date)
+        if last_date == watermark:
+            watermark_ids = meta["watermark_ids"] + watermark_ids
+        self._write(key, new_docs, last_date, watermark_ids, meta["count"] + len(new_docs), meta["bytes"])
+
+    def invalidate(self, key=None):
+        """Remove a key from the cache (the whole cache if key is None)"""
+        if key is None:
+            for name in os.listdir(self.cache_dir):
+                if name.endswith((".bson", ".json")):
+                    os.remove(os.path.join(self.cache_dir, name))
+            return
+
+        for path in self._paths(tuple(key)):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def size(self):
+        """Total size in bytes of the cached documents"""
+        return sum(
+            os.path.getsize(os.path.join(self.cache_dir, name))
+            for name in os.listdir(self.cache_dir) if name.endswith(".bson")
+        )
+
+    def evict(self):
+        """Drop the least recently used keys until the cache fits in max_bytes"""
+        entries = []
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".json"):
+                continue
+            meta_path = os.path.join(self.cache_dir, name)
+            data_path = meta_path[:-len(".json")] + ".bson"
+            size = os.path.getsize(data_path) if os.path.exists(data_path) else 0
+            entries.append((os.path.getmtime(meta_path), size, data_path, meta_path))
+            total += size
+
+        # never evict the most recently used key
+        for _, size, data_path, meta_path in sorted(entries)[:-1]:
+            if total <= self.max_bytes:
+                break
+            for path in (data_path, meta_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            total -= size
+
+
+def _watermarkIds(docs, last_date):
+    """_ids (as strings) of the documents of last_date at the end of docs sorted by date"""
+    ids = []
+    for doc in reversed(docs):
+        if doc["date"] != last_date:
+            break
+        ids.append(str(doc["_id"]))
+    return ids[::-1]
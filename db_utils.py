@@ -2,124 +2,424 @@
 import sys
 sys.path.append("..")
 
+import atexit
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from bson.objectid import ObjectId
-from socket import socket
+from socket import socket, create_connection
 import numpy as np
 from pymongo import MongoClient
 from sshtunnel import SSHTunnelForwarder
+import metrics_utils
 import settings
 
 def getFreePort():
     with socket() as s:
         s.bind(('', 0))
         port = s.getsockname()[1]
-        print(port)
         return port
 
 
+def isPortOpen(port, host="127.0.0.1", timeout=1.0) -> bool:
+    """Return True if something is listening on host:port"""
+    try:
+        with create_connection((host, port), timeout=timeout):
+            return True
+    except OSError:
+        return False
+
+
+class TunnelManager:
+    """
+    Managed ssh tunnel towards the production db
+
+    The tunnel uses ssh keepalives, is restarted on the same local port (with exponential backoff)
+    when it drops, and is closed at exit. If port is given and something already listens on it,
+    that tunnel is reused and no forwarder is started, so many processes can share one tunnel.
+    """
+    def __init__(self, port=None, keepalive=None, max_retries=5, backoff=1.0):
+        self.port = int(port) if port else None
+        self.keepalive = keepalive if keepalive is not None else settings.SSH_KEEPALIVE
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.server = None
+        self._lock = threading.Lock()
+        atexit.register(self.stop)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _newForwarder(self, port):
+        return SSHTunnelForwarder(
+            (settings.IP_EC2, 22),
+            ssh_username="ubuntu",
+            ssh_pkey=settings.SSH_PKEY,
+            remote_bind_address=(settings.REMOTE_BIND_ADDRESS, 27017),
+            local_bind_address=('0.0.0.0', port),
+            set_keepalive=self.keepalive,
+        )
+
+    def start(self) -> int:
+        """Start (or reuse) the tunnel and return its local port"""
+        if self.port is not None and self.server is None and isPortOpen(self.port):
+            return self.port
+        if self.port is None:
+            self.port = getFreePort()
+
+        delay = self.backoff
+        for attempt in range(self.max_retries):
+            try:
+                self.server = self._newForwarder(self.port)
+                self.server.start()
+                return self.port
+            except Exception:
+                self.server = None
+                if attempt == self.max_retries - 1:
+                    raise
+                time.sleep(delay)
+                delay *= 2
+
+    def isAlive(self) -> bool:
+        """
+        Return True if the tunnel is up
+
+        Only local state is checked (forwarder running, ssh transport active): check_tunnels() would
+        open a connection to the remote db and wait for its timeout on every call.
+        """
+        if self.server is None:
+            return self.port is not None and isPortOpen(self.port)
+        transport = getattr(self.server, "_transport", None)
+        return self.server.is_active and transport is not None and transport.is_active()
+
+    def ensure(self) -> int:
+        """Restart the tunnel on the same port if it dropped"""
+        with self._lock:
+            if not self.isAlive():
+                self.stop()
+                self.start()
+            return self.port
+
+    def stop(self):
+        """Close the tunnel (a reused tunnel is left running)"""
+        if self.server is not None:
+            self.server.stop()
+            self.server = None
+
+
+def clientOptions(**overrides) -> dict:
+    """
+    Build the MongoClient keyword arguments from settings
+
+    :param overrides: options that take precedence over settings
+    """
+    options = {}
+    if settings.MONGO_MAX_POOL_SIZE:
+        options["maxPoolSize"] = int(settings.MONGO_MAX_POOL_SIZE)
+    if settings.MONGO_COMPRESSORS:
+        options["compressors"] = settings.MONGO_COMPRESSORS
+    if settings.MONGO_TIMEOUT_MS:
+        timeout = int(settings.MONGO_TIMEOUT_MS)
+        options.update(serverSelectionTimeoutMS=timeout, connectTimeoutMS=timeout, socketTimeoutMS=timeout)
+    if settings.MONGO_READ_PREFERENCE:
+        options["readPreference"] = settings.MONGO_READ_PREFERENCE
+    options.update(overrides)
+    return options
+
+
 class MongoManager:
+    """
+    Lazy singleton of the production MongoClient
+
+    The client (and in local mode the ssh tunnel) is created on the first getInstance() call.
+    In local mode every getInstance() checks the tunnel and restarts it if it dropped.
+    """
     __instance = None
+    __localInstance = None
+    __tunnel = None
+    __lock = threading.Lock()
     @staticmethod
-    def getInstance():
+    def getInstance(**options):
+        """Return the production client, creating it with the given MongoClient options if needed"""
         if MongoManager.__instance == None:
-            MongoManager()
+            with MongoManager.__lock:
+                # another thread may have created it while this one was waiting
+                if MongoManager.__instance == None:
+                    MongoManager(**options)
+                    return MongoManager.__instance
+        if MongoManager.__tunnel is not None:
+            MongoManager.__tunnel.ensure()
         return MongoManager.__instance
-    def __init__(self):
+    @staticmethod
+    def getLocalInstance(url=None, **options):
+        """Return a client for a local/offline db (settings.MONGO_LOCAL_URL by default), no ssh tunnel involved"""
+        if url is not None:
+            return MongoClient(url, **clientOptions(**options))
+        with MongoManager.__lock:
+            if MongoManager.__localInstance == None:
+                MongoManager.__localInstance = MongoClient(settings.MONGO_LOCAL_URL, **clientOptions(**options))
+        return MongoManager.__localInstance
+    @staticmethod
+    def close():
+        """Close the production client and its ssh tunnel"""
+        if MongoManager.__instance is not None:
+            MongoManager.__instance.close()
+            MongoManager.__instance = None
+        if MongoManager.__tunnel is not None:
+            MongoManager.__tunnel.stop()
+            MongoManager.__tunnel = None
+    def __init__(self, **options):
+        options = clientOptions(**options)
         if (settings.LOCATION == "local"):
-            pickedPort = getFreePort()
-            server = SSHTunnelForwarder(
-                (settings.IP_EC2, 22),
-                ssh_username="ubuntu",
-                ssh_pkey=settings.SSH_PKEY,
-                remote_bind_address=(settings.REMOTE_BIND_ADDRESS, 27017),
-                local_bind_address=('0.0.0.0', pickedPort)
-            )
-            # start ssh tunnel
-            server.start()
+            # start (or reuse) ssh tunnel
+            MongoManager.__tunnel = TunnelManager(port=settings.SSH_TUNNEL_PORT)
+            pickedPort = MongoManager.__tunnel.start()
             MongoManager.__instance = MongoClient("127.0.0.1", pickedPort, username=settings.USERNAME_DB,
                                                     password=settings.PWD_DB, tls=True, tlsCAFile=settings.SSL_CA_CERTS,
-                                                    tlsAllowInvalidHostnames=True, directConnection=True, retryWrites = False)
+                                                    tlsAllowInvalidHostnames=True, directConnection=True, retryWrites = False,
+                                                    **options)
         else:
-            MongoManager.__instance = MongoClient(settings.MONGO_URL)
-        # TODO aggiugnere parametreo al costruttore per la connessione al db locale
+            MongoManager.__instance = MongoClient(settings.MONGO_URL, **options)
+    def __enter__(self):
+        return MongoManager.__instance
+    def __exit__(self, *exc):
+        MongoManager.close()
+
+
+def getClient() -> MongoClient:
+    """Return the production client (created on first use)"""
+    return MongoManager.getInstance()
 
 
-dbClient = MongoManager.getInstance()
+def __getattr__(name):
+    # db_utils.dbClient is resolved lazily, importing the module does not open any connection
+    if name == "dbClient":
+        return getClient()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-def findCustomers() -> list:
+
+METADATA_TTL = 3600  # seconds
+
+
+class MetadataCache:
+    """
+    TTL cache of the customer metadata (users and structures), with explicit refresh
+
+    Besides the raw documents it keeps the lookup indexes used by the fleet loops:
+    customer -> dbs, structure id -> structure, eui -> sensor (type, rev), group -> device EUIs.
+    Every entry (the customers, the structures of one db) expires after ttl seconds;
+    refresh() drops entries on demand. Safe to share between threads.
+    """
+
+    def __init__(self, ttl=METADATA_TTL):
+        self.ttl = ttl
+        self._entries = {}  # key -> (expiry, value)
+        self._lock = threading.Lock()
+
+    def _get(self, key, loader):
+        now = time.monotonic()
+        with self._lock:
+            cached = self._entries.get(key)
+        if cached is not None and cached[0] > now:
+            metrics_utils.count(cache_hits=1)
+            return cached[1]
+        value = loader()
+        with self._lock:
+            self._entries[key] = (now + self.ttl, value)
+        return value
+
+    def refresh(self, dbName=None):
+        """Drop the cached metadata of a db (all of it if dbName is None), it is reloaded on next use"""
+        with self._lock:
+            if dbName is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(("db", str(dbName)), None)
+        for key in [key for key in _deckTypeCache if dbName is None or key[0] == dbName]:
+            _deckTypeCache.pop(key, None)
+
+    def customers(self) -> list:
+        return self._get(("customers",), lambda: findCustomers())
+
+    def customerDbs(self) -> dict:
+        """customer username -> names of its dbs (named <something>_<username>)"""
+        def load():
+            dbNames = getClient().list_database_names()
+            return {customer["username"]: [name for name in dbNames if name.endswith("_" + customer["username"])]
+                    for customer in self.customers()}
+        return self._get(("customerDbs",), load)
+
+    def _dbIndex(self, dbName) -> dict:
+        def load():
+            structures = findStructures(str(dbName))
+            index = {"structures": structures, "byID": {}, "sensors": {}, "groups": {}}
+            for structure in structures:
+                index["byID"][str(structure["_id"])] = structure
+                for sensor in structure.get("sensors", []):
+                    index["sensors"][sensor["eui"]] = sensor
+                for group in structure.get("groups", []):
+                    index["groups"][str(group["_id"])] = [device["eui"] for device in group.get("devices", [])]
+            return index
+        return self._get(("db", str(dbName)), load)
+
+    def structures(self, dbName) -> list:
+        return self._dbIndex(dbName)["structures"]
+
+    def structure(self, dbName, structureID):
+        """Structure document by id (None if not found)"""
+        return self._dbIndex(dbName)["byID"].get(str(structureID))
+
+    def sensor(self, dbName, eui):
+        """Sensor document (eui, type, rev, ...) by eui (None if not found)"""
+        return self._dbIndex(dbName)["sensors"].get(eui)
+
+    def groupEuis(self, dbName, group) -> list:
+        """EUIs of the devices of a group (by group id)"""
+        return self._dbIndex(dbName)["groups"].get(str(group), [])
+
+
+@metrics_utils.instrumented
+def findCustomers(metadata=None) -> list:
     """
     Find the requested customer. Return db cursor for the given customer(s)
 
     :param customer: Name of the customer
     :param single: Set to True if you are looking for a single customer
+    :param metadata: optional MetadataCache, the users are read from the db only when expired
 
     :return: List of found customer(s)
     """
+    if metadata is not None:
+        return metadata.customers()
 
-    global_db = dbClient["global"]
+    global_db = getClient()["global"]
     collection = global_db["users"]
 
     customer_cursor = collection.find({"username": {"$ne": "admin"}, "$or": [{"type":{"$exists": False}},{"type":"standard"}]})
 
-    return list(customer_cursor)
+    customers = list(customer_cursor)
+    metrics_utils.count(docs=len(customers))
+    return customers
 
 
-def findStructures(dbName: str) -> list:
+@metrics_utils.instrumented
+def findStructures(dbName: str, metadata=None) -> list:
     """
     Find and return list of structures for a given customer
 
     :param dbName: Name of the db (usually deck_something)
     :param structureID: String represeting the ID of the structure
+    :param metadata: optional MetadataCache, the structures are read from the db only when expired
 
     :return: List of mongo documents relative to the structure(s) found
     """
-    customerDb = dbClient[dbName]
+    if metadata is not None:
+        return metadata.structures(dbName)
+
+    customerDb = getClient()[dbName]
     collection = customerDb["structures"]
 
     structures_cursor = collection.find({})
 
-    return list(structures_cursor)
+    structures = list(structures_cursor)
+    metrics_utils.count(docs=len(structures))
+    return structures
 
 
-def findSensors(customerDb) -> list:
+@metrics_utils.instrumented
+def findSensors(customerDb, metadata=None) -> list:
     """
     Find and return the list of sensors for a given structure
+
+    :param metadata: optional MetadataCache, the structures are read from the db only when expired
     """
+    if metadata is not None:
+        structures = metadata.structures(customerDb.name)
+        return [sensor['eui'] for sensor in structures[0]['sensors']] if structures else []
+
     mycol = customerDb["structures"]
     structure = mycol.find_one()
     eui_list = list(map(lambda x: x['eui'], structure['sensors']))
     return eui_list
 
 
-def findSensorType(dbName,group,structure):
-    customerDb = dbClient[str(dbName)]
+SENSOR_TYPE_TTL = 3600  # seconds
+_deckTypeCache = {}  # (dbName, eui) -> (expiry, sensor type)
+
+
+def _isShortDeck(customerDb, eui) -> bool:
+    """True if the deck sensor sends 1600 samples events (deckShort1600)"""
+    event = customerDb["vibrations"].find_one({"eui": eui, "payload.dati.1599": { "$exists": True },
+                                               "payload.dati.2999": { "$exists": False }}, {"_id": 1})
+    return event is not None
+
+
+def _deckSensorTypes(dbName, euis, ttl=SENSOR_TYPE_TTL, max_workers=8) -> dict:
+    """
+    Classify deck sensors as type 1 or 4, memoizing the result per (db, eui) for ttl seconds
+
+    The vibrations lookups of the EUIs not in cache run concurrently, one bounded query per EUI.
+    """
+    now = time.monotonic()
+    result = {}
+    missing = []
+    for eui in set(euis):
+        cached = _deckTypeCache.get((dbName, eui))
+        if cached is not None and cached[0] > now:
+            result[eui] = cached[1]
+            metrics_utils.count(cache_hits=1)
+        else:
+            missing.append(eui)
+
+    if missing:
+        customerDb = getClient()[str(dbName)]
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(missing))) as executor:
+            shorts = executor.map(lambda eui: _isShortDeck(customerDb, eui), missing)
+            for eui, short in zip(missing, shorts):
+                result[eui] = 4 if short else 1
+                _deckTypeCache[(dbName, eui)] = (now + ttl, result[eui])
+
+    return result
+
 
-    sensor_type = False
-    if (np.shape(group["devices"])[0] == 0):
-        return sensor_type
+@metrics_utils.instrumented
+def findSensorTypes(dbName, groups, structure=None, ttl=SENSOR_TYPE_TTL, metadata=None) -> list:
+    """
+    Find the sensor type of many groups of a structure at once
 
+    :param groups: list of group documents (with the "devices" list)
+    :param structure: structure document of the groups (not needed when metadata is given)
+    :param metadata: optional MetadataCache, the sensors are looked up in its eui index
+    :return: list with the sensor type of every group (False if unknown or without devices)
+    """
+    euis = [group["devices"][0]["eui"] if np.shape(group["devices"])[0] > 0 else None for group in groups]
+    if metadata is not None:
+        sensors = {eui: metadata.sensor(dbName, eui) for eui in euis}
+        sensors = {eui: sensor for eui, sensor in sensors.items() if sensor is not None}
     else:
-        eui = group["devices"][0]["eui"]
-        for i in range (np.shape(structure['sensors'])[0]):
-            if (structure['sensors'][i]['eui'] == eui):
-                type = structure['sensors'][i]['type']    
-                if (type == 'accelerometer'):
-                    rev = structure['sensors'][i]['rev']
-                    if (rev == '3.0'):
-                        sensor_type = 3
-                    else:
-                        sensor_type = 2
-                elif (type == 'deck'):
-                    mycol = customerDb["vibrations"]
-                    event = list(mycol.find({"eui": eui, "payload.dati.1599": { "$exists": True },
-                                "payload.dati.2999": { "$exists": False }}).limit(1))
-                    if (np.shape(event)[0] == 0):
-                        sensor_type = 1
-                    else:
-                        sensor_type = 4
-                break
-                    
-        return sensor_type
+        sensors = {sensor['eui']: sensor for sensor in structure['sensors']}
+
+    deck_euis = [eui for eui in euis if eui in sensors and sensors[eui]['type'] == 'deck']
+    deck_types = _deckSensorTypes(dbName, deck_euis, ttl) if deck_euis else {}
+
+    sensor_types = []
+    for eui in euis:
+        sensor_type = False
+        sensor = sensors.get(eui)
+        if sensor is not None:
+            if (sensor['type'] == 'accelerometer'):
+                sensor_type = 3 if sensor['rev'] == '3.0' else 2
+            elif (sensor['type'] == 'deck'):
+                sensor_type = deck_types[eui]
+        sensor_types.append(sensor_type)
 
+    return sensor_types
 
 
+@metrics_utils.instrumented
+def findSensorType(dbName,group,structure=None,metadata=None):
+    return findSensorTypes(dbName, [group], structure, metadata=metadata)[0]
@@ -13,6 +13,8 @@ import datetime as dtt
 from datetime import datetime, timedelta
 
 import db_utils
+import metrics_utils
+from traces_utils import toDays
 
 SWITCHER = {
         1: "deck",
@@ -21,13 +23,120 @@ SWITCHER = {
         4: "deckShort1600"
     }
 
-def DownloadTemperatures(db_client: MongoClient, db_name):
+TEMPERATURE_ROLLUP = "temperatures_daily"
 
 
-    coll = db_client[db_name]['temperatures']
+def _TemperatureEuis(db_client, db_name, structureID, group):
+    """EUIs of a structure, or of one of its groups, read from the structures collection"""
+    structure = db_client[db_name]['structures'].find_one({"_id": ObjectId(structureID)})
+    if structure is None:
+        return []
+    if group is not None:
+        for structure_group in structure.get('groups', []):
+            if str(structure_group['_id']) == str(group):
+                return [device['eui'] for device in structure_group['devices']]
+    return [sensor['eui'] for sensor in structure['sensors']]
 
-    print("Downloading temperatures...")
-    tmps = list(coll.aggregate([
+
+def UpdateTemperatureRollup(db_client, db_name, rollup_coll=TEMPERATURE_ROLLUP):
+    """
+    Update the materialized daily rollup (one document per day and eui) of the temperatures collection
+
+    Only the days from the last rolled-up one onwards are recomputed; the last day is
+    recomputed entirely because it may have been incomplete.
+    """
+    db = db_client[db_name]
+    rollup = db[rollup_coll]
+    rollup.create_index("_id.date")
+
+    last = rollup.find_one({}, {"_id": 1}, sort=[("_id.date", -1)])
+    match = {"date": {"$gte": datetime.strptime(last['_id']['date'], '%Y-%m-%d')}} if last else {}
+
+    db['temperatures'].aggregate([
+            {"$match": match},
+            {"$group": {
+                "_id": { "date": {'$dateToString': { 'format': "%Y-%m-%d", 'date': "$date", }},
+                         "eui": "$eui"
+                },
+                "sum": {"$sum": "$temperature" },
+                "count": {"$sum": 1 },
+                "min": {"$min": "$temperature" },
+                "max": {"$max": "$temperature" },
+            }},
+            {"$merge": {"into": rollup_coll, "on": "_id", "whenMatched": "replace", "whenNotMatched": "insert"}}
+            ])
+
+
+@metrics_utils.instrumented
+def DownloadTemperatures(db_client: MongoClient, db_name, structureID=None, group=None, sensorType=None,
+                         euis=None, start=None, end=None, rollup=False):
+    """
+    Download the daily max, min and average temperatures
+
+    :param structureID: if given (and euis is None) only the sensors of the structure are used
+    :param group: if given together with structureID only the devices of the group are used
+    :param sensorType: unused, kept for the signature shared with the plotting_utils downloaders
+    :param euis: list of sensor EUIs to use
+    :param start: first datetime to use (included)
+    :param end: last datetime to use (excluded)
+    :param rollup: if True update and read the daily rollup collection instead of scanning the temperatures
+        (whole days only: start and end are truncated to the day)
+    """
+    if euis is None and structureID is not None:
+        euis = _TemperatureEuis(db_client, db_name, structureID, group)
+
+    metrics_utils.log("Downloading temperatures...")
+    if rollup:
+        with metrics_utils.phase("rollup"):
+            UpdateTemperatureRollup(db_client, db_name)
+        match = {}
+        if euis is not None:
+            match["_id.eui"] = {"$in": list(euis)}
+        if start is not None or end is not None:
+            match["_id.date"] = {}
+            if start is not None:
+                match["_id.date"]["$gte"] = start.strftime('%Y-%m-%d')
+            if end is not None:
+                match["_id.date"]["$lt"] = end.strftime('%Y-%m-%d')
+
+        with metrics_utils.phase("query"):
+            tmps = list(db_client[db_name][TEMPERATURE_ROLLUP].aggregate([
+                    {"$match": match},
+                    {"$group": {
+                        "_id": { "date": "$_id.date" },
+                        "sum": {"$sum": "$sum" },
+                        "count": {"$sum": "$count" },
+                        "min_temperature": {"$min": "$min" },
+                        "max_temperature": {"$max": "$max" },
+                    }},
+                    {"$addFields": {"avg_temperature": {"$divide": ["$sum", "$count"]}}},
+                    {"$sort": { "_id.date":1} }
+                    ]))
+    else:
+        match = {}
+        if euis is not None:
+            match["eui"] = {"$in": list(euis)}
+        if start is not None or end is not None:
+            match["date"] = {}
+            if start is not None:
+                match["date"]["$gte"] = start
+            if end is not None:
+                match["date"]["$lt"] = end
+
+        coll = db_client[db_name]['temperatures']
+        with metrics_utils.phase("query"):
+            tmps = list(coll.aggregate(_DailyTemperaturePipeline(match)))
+
+    metrics_utils.count(docs=len(tmps))
+
+    with metrics_utils.phase("regroup"):
+        return _DailyTemperatures(tmps)
+
+
+def _DailyTemperaturePipeline(match):
+    """Aggregation of the temperatures matching match into daily avg, min and max"""
+    return [
+            {"$match": match},
             {"$group": {
                 "_id": { "date": {'$dateToString': { 'format': "%Y-%m-%d", 'date': "$date", }},
                        #  "eui": "$eui"
@@ -37,8 +146,11 @@ def DownloadTemperatures(db_client: MongoClient, db_name):
                 "max_temperature": {"$max": "$temperature" },
             }},
             {"$sort": { "_id.date":1} }
-            ]))
+            ]
+
 
+def _DailyTemperatures(tmps):
+    """days, temp_max, temp_min, temp_avg (as DownloadTemperatures) of the daily aggregation documents"""
     days = sorted(set([datetime.strptime(d['_id']['date'], '%Y-%m-%d') for d in tmps]))
     temp_max = [doc['max_temperature'] for doc in tmps]
     temp_min = [doc['min_temperature'] for doc in tmps]
@@ -47,7 +159,8 @@ def DownloadTemperatures(db_client: MongoClient, db_name):
     return days, temp_max, temp_min, temp_avg
 
 
-def PlotTemperatures(days, temp_max, temp_min, temp_avg):
+def PlotTemperatures(days, temp_max, temp_min, temp_avg, show=True):
+    """Plot the daily temperatures; with show=False the figure is only returned (headless use)"""
 
     fig = go.Figure()
 
@@ -57,7 +170,121 @@ def PlotTemperatures(days, temp_max, temp_min, temp_avg):
 
     fig.update_layout(title="Temperatures",  xaxis_title='Days', yaxis_title='Temperature [°C]')
 
-    fig.show()
+    if show:
+        fig.show()
+    return fig
+
+
+def _DayIndex(days, temps):
+    """Temperatures sorted by day, as datetime64[D] and float64 arrays"""
+    days = toDays(days)
+    temps = np.asarray(temps, dtype=np.float64)
+    order = np.argsort(days, kind='stable')
+    return days[order], temps[order]
+
+
+def _SegmentSums(segments, values, n_segments):
+    return np.bincount(segments, weights=values, minlength=n_segments)
+
+
+def TemperatureFits(traces, temperatures, t_ref=None, skip_outliers=True):
+    """
+    Align the frequency traces with the daily temperatures and fit f = intercept + slope * T
+    for every label of many groups in one batched NumPy pass
+
+    The trace dates are matched to the temperature days on a datetime64[D] index (searchsorted on
+    the concatenated dates of all the series sharing the same temperatures); the sums of the
+    regressions of all the (key, label) series are accumulated with bincount.
+
+    :param traces: dict key -> (ftraces, giornitraces) as returned by plotting_utils.DownloadTraces,
+        key is any hashable (e.g. (db_name, group, axis))
+    :param temperatures: (days, temps) shared by all keys (e.g. days and temp_avg of DownloadTemperatures),
+        or dict key -> (days, temps); keys mapped to the same (days, temps) object are aligned together
+    :param t_ref: reference temperature of the compensated frequencies (default: mean temperature of each series)
+    :param skip_outliers: if True the outliers (label -1) are not fitted
+    :return: dict (key, label) -> dict with
+        n (number of days with a temperature), slope [Hz/°C], intercept [Hz], r (correlation),
+        t_ref, dates (datetime64[D]), freqs, temps (nan on the days without a temperature)
+        and compensated (freqs - slope * (temps - t_ref), nan where temps is nan)
+    """
+    shared = not isinstance(temperatures, dict)
+
+    # series grouped by temperature source, so every source is aligned with a single searchsorted
+    series = []
+    sources = {}
+    for key, (ftraces, giornitraces) in traces.items():
+        source = temperatures if shared else temperatures[key]
+        for label in ftraces.keys():
+            if skip_outliers and label == -1:
+                continue
+            sources.setdefault(id(source), (source, []))[1].append(len(series))
+            series.append((key, label, np.asarray(ftraces[label], dtype=np.float64),
+                           toDays(giornitraces[label])))
+
+    n_series = len(series)
+    lengths = np.fromiter((freqs.shape[0] for _, _, freqs, _ in series), dtype=np.int64, count=n_series)
+    offsets = np.zeros(n_series + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(lengths)
+    freqs = np.concatenate([s[2] for s in series]) if series else np.empty(0)
+    dates = np.concatenate([s[3] for s in series]) if series else np.empty(0, dtype='datetime64[D]')
+    temps = np.full(freqs.shape[0], np.nan)
+
+    for source, indices in sources.values():
+        tdays, tvalues = _DayIndex(*source)
+        if tdays.shape[0] == 0:
+            continue
+        rows = np.concatenate([np.arange(offsets[i], offsets[i + 1]) for i in indices])
+        pos = np.clip(np.searchsorted(tdays, dates[rows]), 0, tdays.shape[0] - 1)
+        found = tdays[pos] == dates[rows]
+        temps[rows[found]] = tvalues[pos[found]]
+
+    # batched regression: centered sums per series
+    segments = np.repeat(np.arange(n_series), lengths)
+    valid = ~np.isnan(temps) & ~np.isnan(freqs)
+    seg, x, y = segments[valid], temps[valid], freqs[valid]
+    n = np.bincount(seg, minlength=n_series).astype(np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mx = _SegmentSums(seg, x, n_series) / n
+        my = _SegmentSums(seg, y, n_series) / n
+        dx = x - mx[seg]
+        dy = y - my[seg]
+        sxx = _SegmentSums(seg, dx * dx, n_series)
+        syy = _SegmentSums(seg, dy * dy, n_series)
+        sxy = _SegmentSums(seg, dx * dy, n_series)
+        slope = np.where(sxx > 0, sxy / sxx, np.nan)
+        intercept = my - slope * mx
+        r = np.where((sxx > 0) & (syy > 0), sxy / np.sqrt(sxx * syy), np.nan)
+
+    reference = mx if t_ref is None else np.full(n_series, float(t_ref))
+    compensated = freqs - slope[segments] * (temps - reference[segments])
+
+    fits = {}
+    for i, (key, label, _, _) in enumerate(series):
+        rows = slice(offsets[i], offsets[i + 1])
+        fits[(key, label)] = {
+            "n": int(n[i]),
+            "slope": slope[i],
+            "intercept": intercept[i],
+            "r": r[i],
+            "t_ref": reference[i],
+            "dates": dates[rows],
+            "freqs": freqs[rows],
+            "temps": temps[rows],
+            "compensated": compensated[rows],
+        }
+    return fits
+
+
+def TemperatureCorrelation(ftraces, giornitraces, days, temps, t_ref=None, skip_outliers=True):
+    """
+    TemperatureFits of a single group
+
+    :param days, temps: daily temperatures (e.g. days and temp_avg of DownloadTemperatures)
+    :return: dict label -> fit (see TemperatureFits)
+    """
+    fits = TemperatureFits({None: (ftraces, giornitraces)}, (days, temps), t_ref, skip_outliers)
+    return {label: fit for (_, label), fit in fits.items()}
+
 
 if __name__=='__main__':
 
@@ -70,6 +297,7 @@ if __name__=='__main__':
         '63172499a46181b32d20d51d',
         3,
         ['0080E11500289CDE'],
+        rollup=True,
     )
 
     PlotTemperatures(days, tmax, tmin, tavg)
\ No newline at end of file
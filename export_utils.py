@@ -0,0 +1,261 @@
+"""Module to export the fdd and temperature collections of a customer db to Parquet/Arrow files."""
+
+import glob
+import json
+import os
+from datetime import datetime
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import index_utils
+import metrics_utils
+
+TRACES_SCHEMA = pa.schema([
+    ("structureID", pa.string()),
+    ("group", pa.string()),
+    ("type", pa.string()),
+    ("axis", pa.string()),
+    ("date", pa.timestamp("ms")),
+    ("label", pa.int32()),
+    ("freq_value", pa.float64()),
+    ("shape_value", pa.list_(pa.float64())),
+])
+PEAKS_SCHEMA = pa.schema([
+    ("structureID", pa.string()),
+    ("group", pa.string()),
+    ("type", pa.string()),
+    ("axis", pa.string()),
+    ("date", pa.timestamp("ms")),
+    ("freqVector", pa.list_(pa.float64())),
+    ("modalshapeVector", pa.list_(pa.list_(pa.float64()))),
+    ("EUIorder", pa.list_(pa.string())),
+    ("ShapeEUIorder", pa.list_(pa.string())),
+    ("TotalTime", pa.float64()),
+    ("fSample", pa.float64()),
+])
+TEMPERATURES_SCHEMA = pa.schema([
+    ("eui", pa.string()),
+    ("date", pa.timestamp("ms")),
+    ("temperature", pa.float64()),
+])
+
+EXTENSIONS = {"parquet": ".parquet", "arrow": ".arrow"}
+
+
+def _str(value):
+    return None if value is None else str(value)
+
+
+def _traceRows(doc):
+    base = (_str(doc.get("structureID")), _str(doc.get("group")), doc.get("type"), doc.get("axis"), doc["date"])
+    for trace in doc.get("traces", []):
+        yield base + (trace["label"], trace["freq_value"], trace.get("shape_value"))
+
+
+def _peakRows(doc):
+    if "freqVector" not in doc:
+        return
+    yield (_str(doc.get("structureID")), _str(doc.get("group")), doc.get("type"), doc.get("axis"), doc["date"],
+           doc["freqVector"], doc.get("modalshapeVector"), doc.get("EUIorder"), doc.get("ShapeEUIorder"),
+           doc.get("TotalTime"), doc.get("fSample"))
+
+
+def _temperatureRows(doc):
+    yield doc.get("eui"), doc["date"], doc.get("temperature")
+
+
+class _ExportState:
+    """
+    Keyset (date, _id) of the last exported document of a collection, and the number of the last chunk
+
+    Saved after all the files of a chunk are written: an interrupted run repeats the last chunk,
+    overwriting its files (same chunk number), instead of losing or duplicating rows.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.date = None
+        self.id = None
+        self.seq = 0
+        if os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            self.date, self.id, self.seq = state["date"], state["id"], state["seq"]
+
+    def query(self, id_type):
+        """Documents after the keyset"""
+        if self.date is None:
+            return {}
+        date = datetime.fromisoformat(self.date)
+        last_id = id_type(self.id)
+        return {"$or": [{"date": {"$gt": date}}, {"date": date, "_id": {"$gt": last_id}}]}
+
+    def commit(self, last_doc):
+        self.date = last_doc["date"].isoformat()
+        self.id = str(last_doc["_id"])
+        self.seq += 1
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"date": self.date, "id": self.id, "seq": self.seq}, f)
+        os.replace(tmp_path, self.path)
+
+
+class _Dataset:
+    """One exported dataset, hive partitioned by month: month=YYYY-MM/part-000001.parquet"""
+
+    def __init__(self, path, schema, rows, fmt):
+        self.path = path
+        self.schema = schema
+        self.rows = rows
+        self.fmt = fmt
+
+    def write(self, docs, seq):
+        """Write the rows of a chunk of documents, one file per month; return the number of rows"""
+        months = {}
+        for doc in docs:
+            for row in self.rows(doc):
+                months.setdefault(doc["date"].strftime("%Y-%m"), []).append(row)
+
+        written = 0
+        for month, rows in months.items():
+            table = pa.Table.from_arrays(
+                [pa.array(column, type=field.type) for column, field in zip(zip(*rows), self.schema)],
+                schema=self.schema)
+            partition = os.path.join(self.path, f"month={month}")
+            os.makedirs(partition, exist_ok=True)
+            file_path = os.path.join(partition, f"part-{seq:06d}{EXTENSIONS[self.fmt]}")
+            if self.fmt == "parquet":
+                pq.write_table(table, file_path)
+            else:
+                with pa.OSFile(file_path, "wb") as sink, pa.ipc.new_file(sink, self.schema) as writer:
+                    writer.write_table(table)
+            written += table.num_rows
+        return written
+
+
+def _export(coll, datasets, state, batch_size, chunk_docs, projection=None):
+    """
+    Stream coll sorted by (date, _id) from the keyset of state, chunk_docs documents at a time
+
+    The sort is served by the {date: 1, _id: 1} index of index_utils; without it the server
+    sorts on disk instead of failing on the memory limit.
+    """
+    sample = coll.find_one({}, {"_id": 1})
+    if sample is None:
+        return 0
+    cursor = coll.find(state.query(type(sample["_id"])), projection, allow_disk_use=True) \
+                 .sort([("date", 1), ("_id", 1)]).batch_size(batch_size)
+
+    total = 0
+    chunk = []
+    try:
+        for doc in cursor:
+            chunk.append(doc)
+            if len(chunk) >= chunk_docs:
+                total += _flush(datasets, state, chunk)
+                chunk = []
+        if chunk:
+            total += _flush(datasets, state, chunk)
+    finally:
+        cursor.close()
+    return total
+
+
+def _flush(datasets, state, chunk):
+    with metrics_utils.phase("write"):
+        rows = sum(dataset.write(chunk, state.seq + 1) for dataset in datasets)
+        state.commit(chunk[-1])
+    metrics_utils.count(docs=len(chunk))
+    metrics_utils.log(f"exported {len(chunk)} documents up to {chunk[-1]['date']} ({rows} rows)")
+    return rows
+
+
+@metrics_utils.instrumented
+def ExportFdd(db_client, db_name, coll_name, out_dir, fmt="parquet", batch_size=500, chunk_docs=5000):
+    """
+    Export an fdd collection as two datasets: traces (one row per date and label) and peaks
+    (one row per document with freqVector, modalshapeVector, EUI orders, TotalTime and fSample)
+
+    Memory is bounded by chunk_docs documents. A new run resumes after the last exported
+    document, so the export can be interrupted and repeated to fetch only the new documents.
+
+    :param out_dir: root directory; datasets go to out_dir/db_name/{traces,peaks}/coll_name
+        and the export state to out_dir/db_name/_state/coll_name.fmt.json
+    :param fmt: "parquet" or "arrow" (Arrow IPC files, read with zero copy through memory_map)
+    :return: number of rows written
+    """
+    root = os.path.join(out_dir, str(db_name))
+    datasets = [
+        _Dataset(os.path.join(root, "traces", coll_name), TRACES_SCHEMA, _traceRows, fmt),
+        _Dataset(os.path.join(root, "peaks", coll_name), PEAKS_SCHEMA, _peakRows, fmt),
+    ]
+    state = _ExportState(os.path.join(root, "_state", f"{coll_name}.{fmt}.json"))
+    return _export(db_client[str(db_name)][coll_name], datasets, state, batch_size, chunk_docs)
+
+
+@metrics_utils.instrumented
+def ExportTemperatures(db_client, db_name, out_dir, fmt="parquet", batch_size=5000, chunk_docs=100000):
+    """
+    Export the temperatures collection (eui, date, temperature), resumable as ExportFdd
+
+    The export state is kept per format, so parquet and arrow exports of the same db are independent.
+
+    :return: number of rows written
+    """
+    root = os.path.join(out_dir, str(db_name))
+    dataset = _Dataset(os.path.join(root, "temperatures"), TEMPERATURES_SCHEMA, _temperatureRows, fmt)
+    state = _ExportState(os.path.join(root, "_state", f"temperatures.{fmt}.json"))
+    return _export(db_client[str(db_name)]["temperatures"], [dataset], state, batch_size, chunk_docs,
+                   projection={"eui": 1, "date": 1, "temperature": 1})
+
+
+def ExportCustomerDb(db_client, db_name, out_dir, coll_names=None, fmt="parquet", temperatures=True, **kwargs):
+    """
+    Export all the fdd collections (fdd* by default) and the temperatures of a customer db
+
+    :return: dict collection name -> number of rows written
+    """
+    db = db_client[str(db_name)]
+    written = {}
+    for coll_name in coll_names or index_utils.fddCollections(db):
+        written[coll_name] = ExportFdd(db_client, db_name, coll_name, out_dir, fmt, **kwargs)
+    if temperatures and "temperatures" in db.list_collection_names():
+        written["temperatures"] = ExportTemperatures(db_client, db_name, out_dir, fmt)
+    return written
+
+
+def ReadExport(path, columns=None, months=None, fmt=None):
+    """
+    Read an exported dataset into a pyarrow Table
+
+    Arrow files are memory mapped, so their columns are not copied (use
+    table.column(name).to_numpy() on columns without nulls to get NumPy views).
+
+    :param path: dataset directory (e.g. out_dir/db_name/traces/fdd)
+    :param columns: optional list of columns to read
+    :param months: optional list of "YYYY-MM" partitions to read
+    :param fmt: "parquet" or "arrow", needed only when the dataset was exported in both formats
+        (default: the format of the files found)
+    """
+    files = sorted(glob.glob(os.path.join(path, "month=*", "part-*")))
+    if fmt is None:
+        formats = {name for name, ext in EXTENSIONS.items() for f in files if f.endswith(ext)}
+        if len(formats) > 1:
+            raise ValueError(f"{path} has both parquet and arrow files, pass fmt")
+        fmt = formats.pop() if formats else "parquet"
+    files = [f for f in files if f.endswith(EXTENSIONS[fmt])]
+    if months is not None:
+        files = [f for f in files if os.path.basename(os.path.dirname(f))[len("month="):] in months]
+
+    tables = []
+    for file_path in files:
+        if file_path.endswith(EXTENSIONS["arrow"]):
+            table = pa.ipc.open_file(pa.memory_map(file_path, "r")).read_all()
+            tables.append(table.select(columns) if columns else table)
+        else:
+            tables.append(pq.read_table(file_path, columns=columns, memory_map=True))
+    if not tables:
+        return None
+    return pa.concat_tables(tables)
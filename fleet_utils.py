@@ -0,0 +1,120 @@
+"""Module to download data for many structures/groups/axes concurrently."""
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import db_utils
+import depuration
+import metrics_utils
+import plotting_utils
+
+FleetTarget = namedtuple("FleetTarget", ["db_name", "structureID", "group", "sensorType", "axis", "num_sensori"],
+                         defaults=(None,))
+
+
+def FleetTargets(db_names, axes=("X", "Y", "Z"), metadata=None):
+    """
+    Enumerate the (db, structure, group, axis) targets of the given customer dbs
+
+    Groups are read from the 'groups' field of the structure documents; groups without
+    devices or with an unknown sensor type are skipped.
+
+    :param metadata: optional db_utils.MetadataCache, the structures are read from the db only when expired
+    """
+    targets = []
+    for db_name in db_names:
+        for structure in db_utils.findStructures(db_name, metadata=metadata):
+            groups = structure.get("groups", [])
+            for group, sensorType in zip(groups, db_utils.findSensorTypes(db_name, groups, structure, metadata=metadata)):
+                if not sensorType:
+                    continue
+                for axis in (axes if sensorType in [2,3] else [None]):
+                    targets.append(FleetTarget(db_name, str(structure["_id"]), str(group["_id"]),
+                                               sensorType, axis, len(group["devices"])))
+    return targets
+
+
+def _printProgress(done, total, key, error):
+    status = f"FAILED ({error!r})" if error is not None else "ok"
+    metrics_utils.log(f"[{done}/{total}] {key}: {status}")
+
+
+def _downloadTarget(db_client, target, what, coll_name, initialization_days, track):
+    result = {}
+    if "traces" in what:
+        result["traces"] = plotting_utils.DownloadTraces(
+            db_client, target.db_name, coll_name, target.structureID, target.group, target.sensorType, target.axis)
+    if "peaks" in what:
+        result["peaks"] = plotting_utils.DownloadPeakVector(
+            db_client, target.db_name, target.structureID, target.group, target.sensorType, target.axis,
+            target.num_sensori, track, initialization_days, 'prod', coll_name, stream=True)
+    return result
+
+
+def DownloadFleet(db_client, targets, coll_name, what=("traces", "peaks", "temperatures"),
+                  max_workers=4, initialization_days=14, track=True, progress=_printProgress):
+    """
+    Download traces, peaks and temperatures for many targets at once
+
+    Every target (and every db for the temperatures) is downloaded in its own task on a thread pool,
+    at most max_workers at a time. A failure only affects its own target.
+
+    :param targets: iterable of FleetTarget
+    :param what: any of "traces", "peaks", "temperatures"
+    :param progress: callable(done, total, key, error) called after every task, None to disable
+    :return: dict target -> dict with the requested outputs, or {"error": exception};
+        temperatures are keyed by db name under the "temperatures" key of the returned dict
+    """
+    targets = list(targets)
+    results = {}
+    temperatures = {}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        if set(what) & {"traces", "peaks"}:
+            for target in targets:
+                future = executor.submit(_downloadTarget, db_client, target, what, coll_name, initialization_days, track)
+                futures[future] = ("target", target)
+        if "temperatures" in what:
+            for db_name in sorted({target.db_name for target in targets}):
+                future = executor.submit(depuration.DownloadTemperatures, db_client, db_name)
+                futures[future] = ("temperatures", db_name)
+
+        for done, future in enumerate(as_completed(futures), start=1):
+            kind, key = futures[future]
+            error = future.exception()
+            output = {"error": error} if error is not None else future.result()
+            if kind == "target":
+                results[key] = output
+            else:
+                temperatures[key] = output
+            if progress is not None:
+                progress(done, len(futures), key, error)
+
+    if "temperatures" in what:
+        results["temperatures"] = temperatures
+    return results
+
+
+def FleetTemperatureFits(results, t_ref=None):
+    """
+    Temperature regression of the traces of a DownloadFleet result, all targets in one batched pass
+
+    The traces of every target are fitted against the daily average temperatures of its db.
+    Failed targets and dbs without temperatures are skipped.
+
+    :param results: output of DownloadFleet with "traces" and "temperatures"
+    :return: dict (target, label) -> fit (see depuration.TemperatureFits)
+    """
+    temperatures = {}
+    for db_name, output in results.get("temperatures", {}).items():
+        if not isinstance(output, dict):
+            days, _, _, temp_avg = output
+            temperatures[db_name] = (days, temp_avg)
+    traces = {}
+    for target, output in results.items():
+        if not isinstance(target, FleetTarget) or "traces" not in output or target.db_name not in temperatures:
+            continue
+        ftraces, giornitraces, _ = output["traces"]
+        traces[target] = (ftraces, giornitraces)
+    return depuration.TemperatureFits(traces, {target: temperatures[target.db_name] for target in traces}, t_ref)
@@ -0,0 +1,147 @@
+"""Module to check and create the indexes used by the download functions."""
+
+import argparse
+
+import db_utils
+
+# compound indexes matching the query shapes of plotting_utils, db_utils and depuration
+FDD_INDEXES = [
+    [("structureID", 1), ("group", 1), ("type", 1), ("axis", 1), ("date", 1)],  # sensorType 2, 3
+    [("structureID", 1), ("group", 1), ("date", 1)],  # sensorType 1, 4
+    [("date", 1), ("_id", 1)],  # export_utils keyset
+]
+VIBRATIONS_INDEXES = [
+    [("eui", 1)],  # findSensorType
+]
+TEMPERATURES_INDEXES = [
+    [("eui", 1), ("date", 1)],  # DownloadTemperatures with EUI filters
+    [("date", 1), ("_id", 1)],  # DownloadTemperatures with date filters, daily rollup refresh, export_utils keyset
+]
+
+
+def fddCollections(db):
+    """Names of the fdd collections of a customer db"""
+    return [name for name in db.list_collection_names() if name.startswith("fdd")]
+
+
+def canonicalQueries(db, coll_names=None):
+    """
+    Build the canonical query shapes, filled with values sampled from the collections
+
+    :return: list of (collection name, description, filter, sort)
+    """
+    queries = []
+    for coll_name in coll_names or fddCollections(db):
+        sample = db[coll_name].find_one({}, {"structureID": 1, "group": 1, "type": 1, "axis": 1})
+        if sample is None:
+            continue
+        base = {"structureID": sample["structureID"], "group": sample["group"]}
+        sort = [("date", 1)]
+        if "axis" in sample:
+            queries.append((coll_name, "traces by axis",
+                            dict(base, type=sample["type"], axis=sample["axis"]), sort))
+        else:
+            queries.append((coll_name, "traces by type", dict(base, type=sample["type"]), sort))
+        queries.append((coll_name, "traces by group", base, sort))
+        queries.append((coll_name, "export keyset", {}, [("date", 1), ("_id", 1)]))
+
+    sample = db["vibrations"].find_one({}, {"eui": 1})
+    if sample is not None:
+        queries.append(("vibrations", "sensor type probe",
+                        {"eui": sample["eui"], "payload.dati.1599": {"$exists": True},
+                         "payload.dati.2999": {"$exists": False}}, None))
+
+    sample = db["temperatures"].find_one({}, {"eui": 1, "date": 1})
+    if sample is not None:
+        queries.append(("temperatures", "temperatures by eui and date",
+                        {"eui": {"$in": [sample["eui"]]}, "date": {"$gte": sample["date"]}}, None))
+        queries.append(("temperatures", "temperatures rollup refresh", {"date": {"$gte": sample["date"]}}, None))
+        queries.append(("temperatures", "export keyset", {}, [("date", 1), ("_id", 1)]))
+    return queries
+
+
+def planStages(plan):
+    """Names of all the stages of an explain() plan"""
+    stages = []
+    todo = [plan]
+    while todo:
+        node = todo.pop()
+        if isinstance(node, dict):
+            if "stage" in node:
+                stages.append(node["stage"])
+            for key in ("inputStage", "queryPlan", "winningPlan"):
+                if key in node:
+                    todo.append(node[key])
+            for key in ("inputStages", "shards"):
+                todo.extend(node.get(key, []))
+    return stages
+
+
+def AdviseIndexes(db_client, db_name, coll_names=None):
+    """
+    Explain every canonical query and report collection scans and in-memory sorts
+
+    :return: list of dicts with collection, query description, stages, collscan and in_memory_sort flags
+    """
+    db = db_client[db_name]
+    report = []
+    for coll_name, description, query, sort in canonicalQueries(db, coll_names):
+        cursor = db[coll_name].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        stages = planStages(cursor.explain()["queryPlanner"])
+        report.append({
+            "collection": coll_name,
+            "query": description,
+            "stages": stages,
+            "collscan": "COLLSCAN" in stages,
+            "in_memory_sort": "SORT" in stages,
+        })
+    return report
+
+
+def _hasIndex(coll, keys):
+    return any(list(info["key"]) == keys for info in coll.index_information().values())
+
+
+def EnsureIndexes(db_client, db_name, coll_names=None, create=False):
+    """
+    Check (and optionally create) the recommended indexes
+
+    :param create: if False only report the missing indexes
+    :return: list of (collection, keys) of the missing (or created) indexes
+    """
+    db = db_client[db_name]
+    existing = set(db.list_collection_names())
+    wanted = [(coll_name, keys) for coll_name in coll_names or fddCollections(db) for keys in FDD_INDEXES]
+    wanted += [("vibrations", keys) for keys in VIBRATIONS_INDEXES]
+    wanted += [("temperatures", keys) for keys in TEMPERATURES_INDEXES]
+
+    missing = []
+    for coll_name, keys in wanted:
+        if coll_name not in existing or _hasIndex(db[coll_name], keys):
+            continue
+        missing.append((coll_name, keys))
+        if create:
+            db[coll_name].create_index(keys, background=True)
+    return missing
+
+
+def PrintIndexReport(report):
+    for row in report:
+        problems = [name for name, flag in (("COLLSCAN", row["collscan"]), ("in-memory SORT", row["in_memory_sort"])) if flag]
+        status = ", ".join(problems) if problems else "ok"
+        print(f"{row['collection']:<25} {row['query']:<30} {status:<25} {' <- '.join(row['stages'])}")
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description="Check the query plans and indexes of a customer db")
+    parser.add_argument("db_name")
+    parser.add_argument("--collections", nargs="+", default=None, help="fdd collections (default: fdd*)")
+    parser.add_argument("--create", action="store_true", help="create the missing indexes")
+    args = parser.parse_args()
+
+    client = db_utils.getClient()
+    PrintIndexReport(AdviseIndexes(client, args.db_name, args.collections))
+    for coll_name, keys in EnsureIndexes(client, args.db_name, args.collections, create=args.create):
+        print(f"{'created' if args.create else 'missing'} index on {coll_name}: {keys}")
@@ -0,0 +1,158 @@
+"""Module to follow the new fdd documents of a group through a MongoDB change stream."""
+
+import threading
+import time
+
+import metrics_utils
+import plotting_utils
+
+
+class TraceWatcher:
+    """
+    Live tracking of one structure/group/type/axis.
+
+    The history is downloaded once (through the optional FddCache), then a change stream on the
+    fdd collection, filtered on the same fields, delivers only the new documents: every insert
+    (or replace) is appended to the in-memory slice, written to the cache and pushed to the open
+    figure, a plotly FigureWidget and/or an html file rewritten at every update.
+
+    Change streams need a replica set; for local tests a single-node one is enough
+    (mongod --replSet rs0, then rs.initiate()).
+
+        watcher = TraceWatcher(dbClient, 'deck_sveco', 'fdd_def', structureID, group, 3, 'X',
+                               html_path='tracking.html')
+        watcher.start()
+        ...
+        watcher.stop()
+    """
+
+    def __init__(self, db_client, db_name, coll_name, structureID, group, sensorType, axis=None,
+                 cache=None, figure=None, html_path=None, on_update=None, max_await_ms=1000):
+        """
+        :param cache: optional cache_utils.FddCache used for the initial download and kept up to date
+        :param figure: optional plotly FigureWidget updated in place
+        :param html_path: optional html file rewritten at every update
+        :param on_update: optional callable(watcher, new_docs) called after every update
+        :param max_await_ms: how long the server waits for new changes before every stop check
+        """
+        self.fdd = plotting_utils.FddSlice(db_client, db_name, coll_name, structureID, group, sensorType, axis,
+                                           cache=cache, typed=True)
+        self.db_name = db_name
+        self.structureID = structureID
+        self.group = group
+        self.axis = axis
+        self.cache = cache
+        self.figure = figure
+        self.html_path = html_path
+        self.on_update = on_update
+        self.max_await_ms = max_await_ms
+        self.resume_token = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def pipeline(self) -> list:
+        """Change stream pipeline: inserts and replaces of the documents of the slice"""
+        match = {"operationType": {"$in": ["insert", "replace"]}}
+        match.update({"fullDocument." + field: value for field, value in self.fdd.query.items()})
+        return [{"$match": match}]
+
+    def traces(self):
+        """Current ftraces, giornitraces, fclustermodali (as plotting_utils.DownloadTraces)"""
+        return self.fdd.traces()
+
+    def plot(self):
+        """Figure of the current traces (not shown)"""
+        ftraces, giornitraces, fclustermodali = self.traces()
+        return plotting_utils.PlotTraces(ftraces, None, fclustermodali, None, giornitraces, self.db_name,
+                                         self.axis, str(self.group), str(self.structureID), show=False)
+
+    def apply(self, changes):
+        """
+        Apply change stream events to the slice, the cache and the figure
+
+        :return: list of the new (or replaced) documents
+        """
+        docs = self.fdd.docs
+        positions = {doc["_id"]: i for i, doc in enumerate(docs)}
+        new_docs = []
+        for change in changes:
+            doc = change["fullDocument"]
+            if doc["_id"] in positions:
+                docs[positions[doc["_id"]]] = doc
+            else:
+                positions[doc["_id"]] = len(docs)
+                docs.append(doc)
+            new_docs.append(doc)
+            self.resume_token = change["_id"]
+
+        if not new_docs:
+            return new_docs
+        if any(a["date"] > b["date"] for a, b in zip(docs, docs[1:])):
+            docs.sort(key=lambda doc: doc["date"])
+        if self.cache is not None:
+            self.cache.append(self.fdd.coll, self.fdd.query, new_docs)
+        metrics_utils.log(f"{len(new_docs)} new fdd documents for group {self.group} {self.axis or ''}")
+        self.render()
+        if self.on_update is not None:
+            self.on_update(self, new_docs)
+        return new_docs
+
+    def render(self):
+        """Push the current traces to the FigureWidget and/or the html file"""
+        if self.figure is None and self.html_path is None:
+            return
+        fig = self.plot()
+        if self.figure is not None:
+            with self.figure.batch_update():
+                if len(self.figure.data) == len(fig.data):
+                    # same traces: only x, y and the legend change
+                    for old, new in zip(self.figure.data, fig.data):
+                        old.x, old.y, old.name = new.x, new.y, new.name
+                else:
+                    self.figure.data = []
+                    self.figure.add_traces(fig.data)
+                self.figure.layout.title = fig.layout.title
+        if self.html_path is not None:
+            fig.write_html(self.html_path, include_plotlyjs=True, full_html=True)
+
+    def run(self, max_events=None, timeout=None):
+        """
+        Follow the change stream until stop(), max_events changes or timeout seconds
+
+        The stream is opened before the history is read, so a document inserted in between is not
+        lost (it may be seen twice, apply() replaces it by _id). The stream resumes from its last
+        position, so run() can be called again after a drop.
+        """
+        events = 0
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with self.fdd.coll.watch(self.pipeline(), resume_after=self.resume_token,
+                                 max_await_time_ms=self.max_await_ms) as stream:
+            if self.resume_token is None:
+                self.fdd.docs  # history, then only the changes
+                self.render()
+            while not self._stop.is_set():
+                if deadline is not None and time.monotonic() >= deadline:
+                    break
+                change = stream.try_next()
+                # also advances when there are no matching changes
+                self.resume_token = stream.resume_token or self.resume_token
+                if change is None:
+                    continue
+                self.apply([change])
+                events += 1
+                if max_events is not None and events >= max_events:
+                    break
+        return events
+
+    def start(self):
+        """Run the watcher on a background thread"""
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, wait=True):
+        self._stop.set()
+        if wait and self._thread is not None:
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,182 @@
+"""Module with opt-in instrumentation of the download functions."""
+
+import contextvars
+import functools
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+import bson
+
+logger = logging.getLogger("shm_utils")
+
+_sinks = []
+_current = contextvars.ContextVar("shm_utils_call", default=None)
+
+
+class CallRecord:
+    """Measurements of one call of an instrumented function"""
+
+    def __init__(self, name):
+        self.name = name
+        self.start = time.time()
+        self.duration = None
+        self.phases = {}
+        self.docs = 0
+        self.bytes = 0
+        self.cache_hits = 0
+        self.error = None
+
+    def asDict(self):
+        return {
+            "name": self.name,
+            "start": self.start,
+            "duration": self.duration,
+            "phases": self.phases,
+            "docs": self.docs,
+            "bytes": self.bytes,
+            "cache_hits": self.cache_hits,
+            "error": self.error,
+        }
+
+
+def addSink(sink):
+    """Enable the instrumentation, sending every CallRecord to sink (a callable)"""
+    _sinks.append(sink)
+    return sink
+
+
+def removeSink(sink):
+    _sinks.remove(sink)
+
+
+def enabled() -> bool:
+    return bool(_sinks)
+
+
+def instrumented(func):
+    """Record duration, phases and counters of every call of func when a sink is registered"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _sinks or _current.get() is not None:
+            # disabled, or nested inside another instrumented call that already accounts for it
+            return func(*args, **kwargs)
+        record = CallRecord(func.__name__)
+        token = _current.set(record)
+        t0 = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            record.error = repr(e)
+            raise
+        finally:
+            record.duration = time.perf_counter() - t0
+            _current.reset(token)
+            for sink in list(_sinks):
+                sink(record)
+    return wrapper
+
+
+@contextmanager
+def phase(name):
+    """Time a phase (query, decode, regroup, aggregate, ...) of the current instrumented call"""
+    record = _current.get()
+    if record is None:
+        yield
+        return
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        record.phases[name] = record.phases.get(name, 0.0) + time.perf_counter() - t0
+
+
+def count(docs=0, cache_hits=0, payload=None):
+    """
+    Add counters to the current instrumented call
+
+    :param payload: downloaded documents; their BSON size is added to bytes (only computed when enabled)
+    """
+    record = _current.get()
+    if record is None:
+        return
+    record.docs += docs
+    record.cache_hits += cache_hits
+    if payload:
+        record.bytes += sum(len(doc.raw) if hasattr(doc, "raw") else len(bson.encode(doc)) for doc in payload)
+
+
+def log(message):
+    """Progress message of the download functions"""
+    logger.info(message)
+
+
+class LoggingSink:
+    """Log every call record"""
+
+    def __init__(self, level=logging.INFO):
+        self.level = level
+
+    def __call__(self, record):
+        phases = " ".join(f"{k}={v:.3f}s" for k, v in record.phases.items())
+        logger.log(self.level, f"{record.name} {record.duration:.3f}s docs={record.docs} bytes={record.bytes} "
+                               f"cache_hits={record.cache_hits} {phases}" + (f" error={record.error}" if record.error else ""))
+
+
+class JsonLinesSink:
+    """Append every call record as a json line to a file"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def __call__(self, record):
+        line = json.dumps(record.asDict())
+        with self._lock, open(self.path, "a") as f:
+            f.write(line + "\n")
+
+
+class PrometheusSink:
+    """Accumulate the call records and export them in the Prometheus text format"""
+
+    def __init__(self, prefix="shm_utils"):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self.calls = {}
+        self.errors = {}
+        self.seconds = {}
+        self.phase_seconds = {}
+        self.docs = {}
+        self.bytes = {}
+        self.cache_hits = {}
+
+    def __call__(self, record):
+        with self._lock:
+            name = record.name
+            self.calls[name] = self.calls.get(name, 0) + 1
+            self.errors[name] = self.errors.get(name, 0) + (record.error is not None)
+            self.seconds[name] = self.seconds.get(name, 0.0) + record.duration
+            self.docs[name] = self.docs.get(name, 0) + record.docs
+            self.bytes[name] = self.bytes.get(name, 0) + record.bytes
+            self.cache_hits[name] = self.cache_hits.get(name, 0) + record.cache_hits
+            for phase_name, seconds in record.phases.items():
+                key = (name, phase_name)
+                self.phase_seconds[key] = self.phase_seconds.get(key, 0.0) + seconds
+
+    def export(self) -> str:
+        lines = []
+        with self._lock:
+            for metric, values, kind in (("calls_total", self.calls, "counter"),
+                                         ("errors_total", self.errors, "counter"),
+                                         ("seconds_total", self.seconds, "counter"),
+                                         ("docs_total", self.docs, "counter"),
+                                         ("bytes_total", self.bytes, "counter"),
+                                         ("cache_hits_total", self.cache_hits, "counter")):
+                lines.append(f"# TYPE {self.prefix}_{metric} {kind}")
+                lines.extend(f'{self.prefix}_{metric}{{function="{name}"}} {value}' for name, value in values.items())
+            lines.append(f"# TYPE {self.prefix}_phase_seconds_total counter")
+            lines.extend(f'{self.prefix}_phase_seconds_total{{function="{name}",phase="{phase_name}"}} {value}'
+                         for (name, phase_name), value in self.phase_seconds.items())
+        return "\n".join(lines) + "\n"
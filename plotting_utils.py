@@ -3,11 +3,16 @@
 import plotly
 import plotly.graph_objects as go
 import matplotlib.pyplot as plt
-from operator import add, sub
 from bson.objectid import ObjectId
+from itertools import islice
+import copy
 import numpy as np
 
+import bson_utils
 import db_utils
+import metrics_utils
+import shape_utils
+from traces_utils import TraceSet, _padShapes, modalShapeStats
 
 SWITCHER = {
         1: "deck",
@@ -17,100 +22,264 @@ SWITCHER = {
     }
 
 
-def DownloadTraces(db_client, db_name, coll_name, structureID, group, sensorType, axis=None):
-    """Download a set of traces for plotting purposes"""
+def _FetchFdd(coll, query, cache=None, projection=None):
+    """
+    Return the fdd documents matching query sorted by date, through the local cache if given
+
+    :param projection: fields to download; the cache always keeps (and returns) whole documents
+    """
+    if cache is not None:
+        return cache.load(coll, query)
+    with metrics_utils.phase("query"):
+        fdd = list(coll.find(query, projection).sort("date",1))
+    metrics_utils.count(docs=len(fdd), payload=fdd if metrics_utils.enabled() else None)
+    return fdd
 
-    coll = db_client[db_name][coll_name]
-    query = {
-        "structureID": ObjectId(structureID),
-        "group": ObjectId(group),
-        "type": SWITCHER.get(sensorType)
-        }
 
-    if sensorType in [2,3]:
-        query.update({"axis": axis.upper()})
+def _AggregateTraces(coll, query, shapes=False, axes=None, sensorType=3):
+    """
+    Regroup the traces by label on the server side.
+
+    Only date, label, freq_value (and shape_value if requested) travel over the wire,
+    one document per label instead of one per day.
+
+    :param axes: axes of a multi-axis query: the traces are grouped by axis and label,
+        and a dict axis -> outputs is returned (the same outputs for every axis when the
+        query has no axis filter, i.e. for sensorType 1 and 4)
+    :param sensorType: selects the EUI order the shapes are aligned on, as _GroupTraces
+    """
+    key_eui_order = 'ShapeEUIorder' if sensorType==3 else 'EUIorder'
+    byAxisGroups = bool(axes) and "axis" in query
+    project = {"_id": 0, "date": 1, "traces.label": 1, "traces.freq_value": 1}
+    group_stage = {
+        "_id": {"axis": "$axis", "label": "$traces.label"} if byAxisGroups else "$traces.label",
+        "dates": {"$push": "$date"},
+        "freqs": {"$push": "$traces.freq_value"},
+        "mean": {"$avg": "$traces.freq_value"},
+    }
+    if shapes:
+        project["traces.shape_value"] = 1
+        project[key_eui_order] = 1
+        group_stage["shapes"] = {"$push": "$traces.shape_value"}
+        group_stage["euis"] = {"$push": {"$ifNull": ["$" + key_eui_order, None]}}
+    if byAxisGroups:
+        project["axis"] = 1
+
+    pipeline = [
+        {"$match": query},
+        {"$sort": {"date": 1}},
+        {"$project": project},
+        {"$unwind": "$traces"},
+        {"$group": group_stage},
+    ]
+    with metrics_utils.phase("query"):
+        grouped = list(coll.aggregate(pipeline, allowDiskUse=True))
+    metrics_utils.count(docs=len(grouped), payload=grouped if metrics_utils.enabled() else None)
+
+    if not byAxisGroups:
+        outputs = _GroupedTraces({doc["_id"]: doc for doc in grouped}, shapes)
+        return {axis: outputs for axis in axes} if axes else outputs
+    byAxis = {axis.upper(): {} for axis in axes}
+    for doc in grouped:
+        byAxis[doc["_id"]["axis"]][doc["_id"]["label"]] = doc
+    return {axis: _GroupedTraces(byAxis[axis.upper()], shapes) for axis in axes}
+
+
+def _GroupedTraces(grouped, shapes):
+    """DownloadTraces (or DownloadTracesAndShapes) outputs from the label groups of _AggregateTraces"""
+    # same key order as the client side regrouping (dict built from a set of labels)
+    ftraces = {label: grouped[label]["freqs"] for label in set(grouped)}
+    giornitraces = {label: grouped[label]["dates"] for label in ftraces.keys()}
+    fclustermodali = [grouped[key]["mean"] for key in ftraces.keys() if key != -1]
+
+    if not shapes:
+        return ftraces, giornitraces, fclustermodali
+
+    modalshapetraces = {label: grouped[label]["shapes"] for label in ftraces.keys()}
+    modalshapeclustermodali = [_MeanShape(modalshapetraces[key], grouped[key].get("euis"))
+                               for key in ftraces.keys() if key != -1]
 
-    cursor = coll.find(query).sort("date",1)
-        
-    fdd = list(cursor)
-    labels = [trace['label'] for trace_block in fdd for trace in trace_block['traces']]
+    return ftraces, giornitraces, modalshapetraces, fclustermodali, modalshapeclustermodali
 
-    ftraces = {label: [] for label in set(labels)}
-    giornitraces = {label: [] for label in set(labels)}
 
-    for trace_block in fdd:
-        for trace in trace_block['traces']:
-            ftraces[trace['label']].append(trace['freq_value'])
-            giornitraces[trace['label']].append(trace_block['date'])
+@metrics_utils.instrumented
+def DownloadTraces(db_client, db_name, coll_name, structureID, group, sensorType, axis=None, server_side=False,
+                   cache=None):
+    """
+    Download a set of traces for plotting purposes
 
-    fclustermodali = [np.mean(ftraces[key]) for key in ftraces.keys() if key !=-1]
+    :param server_side: if True regroup the traces by label with an aggregation pipeline,
+        transferring only dates, labels and frequencies
+    :param cache: optional cache_utils.FddCache, only the documents newer than the cached ones are downloaded
+    :param axis: a list of axes downloads all of them with one query and returns a dict axis -> outputs
+    """
 
-    return ftraces, giornitraces, fclustermodali
-    
+    fdd = FddSlice(db_client, db_name, coll_name, structureID, group, sensorType, axis, typed=True, cache=cache)
+    if server_side:
+        return _AggregateTraces(fdd.coll, fdd.query, axes=axis if _IsMultiAxis(axis) else None)
+    if _IsMultiAxis(axis):
+        return {ax: fddAxis.traces() for ax, fddAxis in fdd.byAxis().items()}
 
-def DownloadTracesAndShapes(db_client, db_name, coll_name, structureID, group, sensorType, axis=None):
-    """Download a set of traces for plotting purposes"""
+    return fdd.traces()
 
-    coll = db_client[db_name][coll_name]
-    query = {
-        "structureID": ObjectId(structureID),
-        "group": ObjectId(group),
-        "type": SWITCHER.get(sensorType)
-        }
 
-    if sensorType in [2,3]:
-        query.update({"axis": axis.upper()})
+@metrics_utils.instrumented
+def DownloadTracesAndShapes(db_client, db_name, coll_name, structureID, group, sensorType, axis=None, server_side=False):
+    """
+    Download a set of traces for plotting purposes
 
-    cursor = coll.find(query).sort("date",1)
-        
-    fdd = list(cursor)
-    labels = [trace['label'] for trace_block in fdd for trace in trace_block['traces']]
+    :param server_side: if True regroup the traces by label with an aggregation pipeline,
+        transferring only dates, labels, frequencies and shapes
+    :param axis: a list of axes downloads all of them with one query and returns a dict axis -> outputs
+    """
 
-    ftraces = {label: [] for label in set(labels)}
-    giornitraces = {label: [] for label in set(labels)}
-    modalshapetraces = {label: [] for label in set(labels)}
+    fdd = FddSlice(db_client, db_name, coll_name, structureID, group, sensorType, axis, typed=True)
+    if server_side:
+        return _AggregateTraces(fdd.coll, fdd.query, shapes=True, axes=axis if _IsMultiAxis(axis) else None,
+                                sensorType=sensorType)
+    if _IsMultiAxis(axis):
+        return {ax: fddAxis.tracesAndShapes() for ax, fddAxis in fdd.byAxis().items()}
 
-    for trace_block in fdd:
-        for trace in trace_block['traces']:
-            ftraces[trace['label']].append(trace['freq_value'])
-            giornitraces[trace['label']].append(trace_block['date'])
-            modalshapetraces[trace['label']].append(trace['shape_value'])
+    return fdd.tracesAndShapes()
 
-    fclustermodali = [np.mean(ftraces[key]) for key in ftraces.keys() if key !=-1]
-    modalshapeclustermodali = [np.mean(modalshapetraces[key], axis=0) for key in ftraces.keys() if key!=-1]
 
-    return ftraces, giornitraces, modalshapetraces, fclustermodali, modalshapeclustermodali
-    
+
+@metrics_utils.instrumented
+def DownloadTraceSet(db_client, db_name, coll_name, structureID, group, sensorType, axis=None, shapes=False,
+                     cache=None):
+    """
+    Download a set of traces into a columnar TraceSet.
+
+    Use TraceSet.toDicts() to get back ftraces, giornitraces and modalshapetraces for PlotTraces.
+
+    :param axis: a list of axes downloads all of them with one query and returns a dict axis -> TraceSet
+        (the same TraceSet for every axis for sensorType 1 and 4, which have no axis)
+    :param cache: optional cache_utils.FddCache, only the documents newer than the cached ones are downloaded
+    """
+
+    projection = {"_id": 0, "date": 1, "traces.label": 1, "traces.freq_value": 1}
+    if shapes:
+        projection["traces.shape_value"] = 1
+    if _IsMultiAxis(axis):
+        projection["axis"] = 1
+
+    fdd = FddSlice(db_client, db_name, coll_name, structureID, group, sensorType, axis, cache=cache, typed=True,
+                   projection=projection)
+    if _IsMultiAxis(axis) and sensorType in [2,3]:
+        return {ax: fddAxis.traceSet(shapes) for ax, fddAxis in fdd.byAxis().items()}
+    traceSet = fdd.traceSet(shapes)
+    if _IsMultiAxis(axis):
+        return {ax: traceSet for ax in axis}  # no axis filter for these sensor types
+    return traceSet
+
+
+def _Lttb(x, y, n_out):
+    """
+    Largest-Triangle-Three-Buckets downsampling
+
+    :param x: numeric array (sorted)
+    :param y: numeric array
+    :return: indices of the n_out points to keep
+    """
+    n = x.shape[0]
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    idx = np.empty(n_out, dtype=np.int64)
+    idx[0], idx[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        # average point of the next bucket
+        nlo, nhi = hi, (edges[i + 2] if i + 2 < n_out - 1 else n)
+        avg_x, avg_y = x[nlo:nhi].mean(), y[nlo:nhi].mean()
+        area = np.abs((x[a] - avg_x) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (avg_y - y[a]))
+        a = lo + int(np.argmax(area))
+        idx[i + 1] = a
+    return idx
+
+
+def _Downsample(x, y, max_points, xrange=None):
+    """
+    Keep the points of (x, y) inside xrange and downsample them to at most max_points with LTTB
+
+    :return: x, y as numpy arrays
+    """
+    x = np.asarray(x, dtype='datetime64[ms]')
+    y = np.asarray(y, dtype=np.float64)
+    if xrange is not None:
+        inside = (x >= np.datetime64(xrange[0], 'ms')) & (x <= np.datetime64(xrange[1], 'ms'))
+        x, y = x[inside], y[inside]
+    if max_points is None or x.shape[0] <= max_points:
+        return x, y
+    valid = ~np.isnan(y)
+    x, y = x[valid], y[valid]
+    idx = _Lttb(x.astype(np.int64).astype(np.float64), y, max_points)
+    return x[idx], y[idx]
 
 
 def PlotTraces(ftraces, fcentrali, fclustermodali, alldays,
                 giornitraces, dbName, axis, groupName,
-                structureID, dftraces=None, boundaries=False):
+                structureID, dftraces=None, boundaries=False,
+                fast=False, max_points=2000, gl_threshold=10000, xrange=None, show=True):
+    """
+    Plot the modal frequency traces (and optionally their boundaries)
 
-    color_list = plotly.colors.qualitative.Plotly
-    color_list.extend(color_list)
+    :param show: if False the figure is only returned (headless use)
+
+    :param fast: if True every trace is downsampled (LTTB) to max_points and WebGL traces
+        are used when the total number of points is above gl_threshold
+    :param xrange: optional (start, end) dates; only the points inside are plotted, so a zoomed
+        range keeps its full resolution when it has less than max_points points
+    """
+
+    # a copy: extending the plotly list itself would double it at every call
+    color_list = list(plotly.colors.qualitative.Plotly) * 2
+
+    if fast:
+        Scatter = go.Scattergl if sum(len(v) for v in ftraces.values()) > gl_threshold else go.Scatter
+        points = lambda x, y: _Downsample(x, y, max_points, xrange)
+    else:
+        Scatter = go.Scatter
+        points = lambda x, y: (x, y) if xrange is None else _Downsample(x, y, None, xrange)
 
     fig = go.Figure()
 
     for key in ftraces.keys():
+        x, y = points(giornitraces[key], ftraces[key])
         if key != -1:
 
-            fig.add_trace(go.Scatter(x=giornitraces[key], y=ftraces[key], mode='lines+markers',
+            fig.add_trace(Scatter(x=x, y=y, mode='lines+markers',
                                         name=f'Trace {key}: {fclustermodali[key]:.5f} Hz', connectgaps=True,
                                         marker=dict(size=6, color=color_list[key]), line=dict(width=2.5),
                                         hovertemplate='<b>Day:</b>: %{x} <br>' + '<b>Freq:</b>: %{y:.2f} <br>'
                                     ))
         else:
-            fig.add_trace(go.Scatter(x=giornitraces[-1], y=ftraces[-1], mode='markers', name='outliers',
+            fig.add_trace(Scatter(x=x, y=y, mode='markers', name='outliers',
                                     marker=dict(size=6, color='grey'),
                                     hovertemplate='<b>Day:</b>: %{x} <br>' + '<b>Freq:</b>: %{y:.2f} <br>'))  
 
     if boundaries:
+        days = np.asarray(alldays, dtype='datetime64[ms]')
+        if xrange is not None:
+            inside = (days >= np.datetime64(xrange[0], 'ms')) & (days <= np.datetime64(xrange[1], 'ms'))
+        else:
+            inside = np.ones(days.shape[0], dtype=bool)
         for key in ftraces.keys():
             if key != -1:
-                upper = list(map(add, fcentrali[key], dftraces[key]))
-                lower = list(map(sub, fcentrali[key], dftraces[key]))
-                fig.add_trace(go.Scatter(x=alldays,
+                central = np.asarray(fcentrali[key], dtype=np.float64)[inside]
+                delta = np.asarray(dftraces[key], dtype=np.float64)[inside]
+                x = days[inside]
+                if fast and x.shape[0] > max_points:
+                    # same points for both limits, so the filled band stays consistent
+                    valid = ~np.isnan(central)
+                    x, central, delta = x[valid], central[valid], delta[valid]
+                    idx = _Lttb(x.astype(np.int64).astype(np.float64), central, max_points)
+                    x, central, delta = x[idx], central[idx], delta[idx]
+                upper = central + delta
+                lower = central - delta
+                fig.add_trace(Scatter(x=x,
                                             name = f"Lower limit {fclustermodali[key]:.5f} Hz",
                                             y=lower,
                                             mode='lines',
@@ -122,7 +291,7 @@ def PlotTraces(ftraces, fcentrali, fclustermodali, alldays,
                                             showlegend=True          
                                             )
                                 )
-                fig.add_trace(go.Scatter(x=alldays,
+                fig.add_trace(Scatter(x=x,
                                             y=upper,
                                             name = f"Upper limit {fclustermodali[key]:.5f} Hz",
                                             mode='lines',
@@ -139,389 +308,471 @@ def PlotTraces(ftraces, fcentrali, fclustermodali, alldays,
 
     fig.update_layout(title=f"Tracking - {dbName} - {axis} axis - {structureID} - group {groupName}",
                         xaxis_title='Days', yaxis_title=f'Modal frequencies {axis} [Hz]')
-    fig.show()
+    if xrange is not None:
+        fig.update_xaxes(range=list(xrange))
+    if show:
+        fig.show()
+    return fig
 
 
-def DownloadInitializationTraces(dbClient, dbName, structureID, group, sensorType, axis, initialization_days, num_sensori, local_or_prod, coll_name):
+def _GroupTraces(blocks, sensorType, shapes=None, euis=False):
     """
-    Download traces (and their mean values) of a 14-day initialization period from any db 
-    (it can be used both for plotting purposes and to skip the init calculations)
+    Regroup the traces of the given blocks by label in a single pass
+
+    :param shapes: collect the shape values too (default: only for sensorType 3)
+    :param euis: also return shapeeuitraces, the EUI order of the block of every shape value
+    :return: ftraces, modalshapetraces, giornitraces (, shapeeuitraces)
     """
-    switcher = {
-        1: "deck",
-        2: "accelerometerComplete",
-        3: "accelerometerComplete",
-        4: "deckShort1600"
-    }
-    
-    if local_or_prod=='local':
-        customerDb = dbClientLocal[str(dbName)]
-    else:
-        customerDb = dbClient[str(dbName)]  # db di produzione
-    
-    fddCollection = customerDb[coll_name]
+    if shapes is None:
+        shapes = sensorType==3
+    key_eui_order = 'ShapeEUIorder' if sensorType==3 else 'EUIorder'
+    ftraces = {}
+    modalshapetraces = {}
+    giornitraces = {}
+    shapeeuitraces = {}
+
+    for tracesBlock in blocks:
+        for singleTrace in tracesBlock['traces']:
+            label = singleTrace['label']
+            if label not in ftraces:
+                ftraces[label] = []
+                modalshapetraces[label] = []
+                giornitraces[label] = []
+                shapeeuitraces[label] = []
+            ftraces[label].append(singleTrace['freq_value'])
+            if shapes:
+                modalshapetraces[label].append(singleTrace['shape_value'])
+                if euis:
+                    shapeeuitraces[label].append(tracesBlock.get(key_eui_order))
+            giornitraces[label].append(tracesBlock['date'])
+
+    # same key order as the dicts built from set(labels)
+    keys = set(ftraces)
+    ftraces = {k: ftraces[k] for k in keys}
+    modalshapetraces = {k: modalshapetraces[k] for k in keys}
+    giornitraces = {k: giornitraces[k] for k in keys}
+
+    if euis:
+        return ftraces, modalshapetraces, giornitraces, {k: shapeeuitraces[k] for k in keys}
+    return ftraces, modalshapetraces, giornitraces
+
+
+def _MeanShape(shapes, eui_orders=None):
+    """
+    Mean modal shape, aligned on the EUIs when every shape has its EUI order
 
-    if sensorType in [2,3]:
-        # breakpoint()
-        fddCursor = fddCollection.find({"structureID": ObjectId(structureID), "group": ObjectId(group) ,"type": switcher.get(sensorType), "axis": axis.upper()}).sort("date",1)
-    elif sensorType==4:
-        fddCursor = fddCollection.find({"structureID": ObjectId(structureID), "group": ObjectId(group) ,"type": switcher.get(sensorType)}).sort("date",1)
-    else:
-        fddCursor = fddCollection.find({"structureID": ObjectId(structureID), "group": ObjectId(group) }).sort("date",1)
-    fdd = list(fddCursor)
-
-    if initialization_days == False: #scarica tutta la serie di tracce
-
-        labels = []
-        # Cerco le label uniche
-        for tracesBlock in fdd:
-            for singleTrace in tracesBlock['traces']:
-                labels.append(singleTrace['label'])
-        # Inizializzo un array per label
-        ftraces = {k: [] for k in set(labels)}
-        modalshapetraces = {k: [] for k in set(labels)}
-        giornitraces = {k: [] for k in set(labels)}
-
- 
-        # Appendo tutti i valori label per label
-        for tracesBlock in fdd:
-            for singleTrace in tracesBlock['traces']:
-                ftraces[singleTrace['label']].append(singleTrace['freq_value'])
-                if sensorType==3:
-                    modalshapetraces[singleTrace['label']].append(singleTrace['shape_value'])
-                giornitraces[singleTrace['label']].append(tracesBlock['date'])
-
-        f1 = []
-        shape1 = []
+    Aligning by position would shift the components after a sensor missing on some days;
+    it is still used when an EUI order is missing or does not match its shape vector.
+    """
+    if eui_orders is not None and (len(eui_orders) != len(shapes) or any(
+            order is None or len(order) != len(shape) for shape, order in zip(shapes, eui_orders))):
+        eui_orders = None
+    return modalShapeStats(shapes, eui_orders)[0]
 
-        if sensorType==3:
 
-            for key in list(ftraces.keys()):
-                if (key != -1):
-                    media = np.mean(ftraces[key])
-                    f1.append(media)
-                    shapemedia = np.zeros(np.shape(modalshapetraces[key][0])[0])
-                    for m in range (np.shape(shapemedia)[0]):
-                        points = []
-                        for j in range(np.shape(ftraces[key])[0]):
-                            points.append(modalshapetraces[key][j][m])
-                        shapemedia[m] = np.mean(points)
-                    shape1.append(list(shapemedia))  
-            fclustermodali = f1
-            modalshapeclustermodali = shape1
+def _ClusterMeans(ftraces, modalshapetraces, sensorType, shapeeuitraces=None):
+    """
+    Mean frequency (and mean modal shape for rev 3.0 accelerometers) of every label except outliers
+
+    :param shapeeuitraces: optional EUI orders of the shapes (see _GroupTraces), to align them on the EUIs
 
-        else:
-            for key in list(ftraces.keys()):
-                if (key != -1):
-                    media = np.mean(ftraces[key])
-                    f1.append(media)
-            fclustermodali = f1
-            modalshapeclustermodali = None
-
-    else: #intialization_days != False
-
-        print(f"Downloading {axis} axis init traces from {local_or_prod} db")
-        key_eui_order = 'ShapeEUIorder' if sensorType==3 else 'EUIorder'
-        
-        fdd_initialization = []
-        giorno = 1
-        while (giorno <= initialization_days): 
-            #print(f" ****** [ giorno {giorno}] ******* TypeSensor {sensorType}, AXIS {axis}")
-            sensorsEuis_new = fdd[giorno-1][key_eui_order]
-
-            if (num_sensori != np.shape(sensorsEuis_new)[0]):
-                giorno = giorno + 1
-                initialization_days = initialization_days + 1
-                continue
-            else:
-                fdd_initialization.append(fdd[giorno-1])
-                giorno = giorno + 1
-
-            # Cerco le label uniche
-            labels = [singleTrace['label'] for tracesBlock in fdd_initialization for singleTrace in tracesBlock['traces']]
-            # Inizializzo un array per label
-            ftraces = {k: [] for k in set(labels)}
-            modalshapetraces = {k: [] for k in set(labels)}
-            giornitraces = {k: [] for k in set(labels)}
-    
-            
-            # Appendo tutti i valori label per label
-            for tracesBlock in fdd_initialization:
-                for singleTrace in tracesBlock['traces']:
-                    ftraces[singleTrace['label']].append(singleTrace['freq_value'])
-                    if sensorType==3:
-                        modalshapetraces[singleTrace['label']].append(singleTrace['shape_value'])
-                    giornitraces[singleTrace['label']].append(tracesBlock['date'])
-
-            f1 = []
-            shape1 = []
-            
+    :return: fclustermodali, modalshapeclustermodali (None if sensorType != 3)
+    """
+    f1 = []
+    shape1 = []
+
+    for key in list(ftraces.keys()):
+        if (key != -1):
+            media = np.mean(ftraces[key])
+            f1.append(media)
             if sensorType==3:
+                # shape vectors of different lengths are masked, not truncated
+                shapemedia = _MeanShape(modalshapetraces[key], shapeeuitraces[key] if shapeeuitraces else None)
+                shape1.append(list(shapemedia))
 
-                for key in list(ftraces.keys()):
-                    if (key != -1):
-                        media = np.mean(ftraces[key])
-                        f1.append(media)  
-                        shapemedia = np.zeros(np.shape(modalshapetraces[key][0])[0])
-                        for m in range (np.shape(shapemedia)[0]):
-                            points = []
-                            for j in range(np.shape(ftraces[key])[0]):
-                                points.append(modalshapetraces[key][j][m])
-                            shapemedia[m] = np.mean(points)
-                        shape1.append(list(shapemedia))  
-                fclustermodali = f1
-                modalshapeclustermodali = shape1
-            
-            else:
-
-                for key in list(ftraces.keys()):
-                    if (key != -1):
-                        media = np.mean(ftraces[key])
-                        f1.append(media)  
-                        
-                fclustermodali = f1
-                modalshapeclustermodali = None
-
-    return ftraces,modalshapetraces, giornitraces, fclustermodali, modalshapeclustermodali
+    return f1, shape1 if sensorType==3 else None
 
 
-def DownloadPeakVector(dbClient, dbName, structureID, group, sensorType, axis,
-            num_sensori, track, initialization_days, local_or_prod, coll_name):
+def _InitializationBlocks(fdd, sensorType, initialization_days, num_sensori):
+    """Yield the first initialization_days blocks having num_sensori sensors"""
+    key_eui_order = 'ShapeEUIorder' if sensorType==3 else 'EUIorder'
+    valid_days = 0
+    for tracesBlock in fdd:
+        if valid_days >= initialization_days:
+            break
+        # skip the days with missing sensors
+        if (num_sensori != np.shape(tracesBlock[key_eui_order])[0]):
+            continue
+        valid_days += 1
+        yield tracesBlock
+
+
+def _IsMultiAxis(axis):
+    return isinstance(axis, (list, tuple))
+
+
+def _AxisFilter(axis):
+    """Filter on the axis field: a single axis, or a list of axes fetched with one $in query"""
+    if _IsMultiAxis(axis):
+        return {"$in": [ax.upper() for ax in axis]}
+    return axis.upper()
+
+
+def _SplitByAxis(docs, axes):
     """
-    Download the freqVector and the modalShapeVector from a db
+    Split the documents of a multi-axis query
+
+    :return: dict axis (as given in axes) -> documents of that axis, in the original order
     """
-    switcher = {
-        1: "deck",
-        2: "accelerometerComplete",
-        3: "accelerometerComplete",
-        4: "deckShort1600"
-    }
-    
-    customerDb = dbClient[str(dbName)] if local_or_prod=='prod' else dbClientLocal[str(dbName)] 
-    fddCollection = customerDb[coll_name]
+    split = {ax: [] for ax in axes}
+    keys = {ax.upper(): ax for ax in axes}
+    for doc in docs:
+        split[keys[doc['axis']]].append(doc)
+    return split
 
+
+def _FddQuery(structureID, group, sensorType, axis):
+    """Query of the fdd documents of a group used by the initialization and peak downloaders"""
+    query = {"structureID": ObjectId(structureID), "group": ObjectId(group)}
     if sensorType in [2,3]:
+        query.update({"type": SWITCHER.get(sensorType), "axis": _AxisFilter(axis)})
+    elif sensorType==4:
+        query.update({"type": SWITCHER.get(sensorType)})
+    return query
 
-        if local_or_prod=='prod':
-            fddCursor = fddCollection.find({"structureID": ObjectId(structureID), "group": ObjectId(group), 
-                                            "type": switcher.get(sensorType), "axis": axis.upper()}).sort("date",1)
-        else:
-            fddCursor = fddCollection.find({"structureID": ObjectId(structureID), "group": ObjectId(group),
-                                        "type": switcher.get(sensorType), "axis": axis.upper()}).sort("date",1)
 
-    elif sensorType == 4:
+@metrics_utils.instrumented
+def DownloadInitializationTraces(dbClient, dbName, structureID, group, sensorType, axis, initialization_days, num_sensori, local_or_prod, coll_name,
+                                cache=None):
+    """
+    Download traces (and their mean values) of a 14-day initialization period from any db 
+    (it can be used both for plotting purposes and to skip the init calculations)
 
-        if local_or_prod=='prod':
-            fddCursor = fddCollection.find({"structureID": ObjectId(structureID), "group": ObjectId(group),
-                                            "type": switcher.get(sensorType)}).sort("date",1)
-        else:
-            fddCursor = fddCollection.find({"structureID": ObjectId(structureID), "group": ObjectId(group),
-                                        "type": switcher.get(sensorType)}).sort("date",1)
+    :param cache: optional cache_utils.FddCache, only the documents newer than the cached ones are downloaded
+    :param axis: a list of axes downloads all of them with one query and returns a dict axis -> outputs
+    """
+    # only 'local' selects the local db here, any other value production
+    fdd = FddSlice(_CustomerClient(dbClient, local_or_prod=='local'), dbName, coll_name, structureID, group, sensorType, axis,
+                   cache=cache)
+    if initialization_days != False:
+        metrics_utils.log(f"Downloading {axis} axis init traces from {local_or_prod} db")
+    if _IsMultiAxis(axis):
+        return {ax: fddAxis.initializationTraces(initialization_days, num_sensori)
+                for ax, fddAxis in fdd.byAxis().items()}
+    return fdd.initializationTraces(initialization_days, num_sensori)
 
-    else:
 
-        if local_or_prod=='prod':
-            fddCursor = fddCollection.find({"structureID": ObjectId(structureID), "group": ObjectId(group),
-                                           }).sort("date",1)
-        else:
-            fddCursor = fddCollection.find({"structureID": ObjectId(structureID), "group": ObjectId(group),
-                                           }).sort("date",1)
+PEAK_PROJECTION = {"_id": 0, "date": 1, "freqVector": 1, "modalshapeVector": 1,
+                   "EUIorder": 1, "ShapeEUIorder": 1, "TotalTime": 1}
+
+
+def _PeakBlocks(fdd, sensorType, num_sensori, track, initialization_days):
+    """Blocks used by DownloadPeakVector: the valid initialization days, or every day after them when tracking"""
+    if not track:
+        return _InitializationBlocks(fdd, sensorType, initialization_days, num_sensori)
+    return islice(fdd, initialization_days, None)
+
+
+def _PeakCursor(coll, query, projection, track, initialization_days, batch_size):
+    """
+    Cursor of the peak documents sorted by date
+
+    When tracking, the initialization days are skipped by the server instead of being
+    transferred and dropped: pass 0 initialization days to _PeakBlocks.
+    """
+    cursor = coll.find(query, projection).sort("date",1).batch_size(batch_size)
+    return cursor.skip(initialization_days) if track else cursor
+
+
+def _PeakRecords(blocks, sensorType, shapes=True):
+    """Yield (date, freqVector, modalshapeVector, EUIorder, TotalTime) for every block"""
+    key_eui_order = "ShapeEUIorder" if sensorType==3 else "EUIorder"
+    for block in blocks:
+        yield (block['date'], block['freqVector'], block['modalshapeVector'] if sensorType==3 and shapes else None,
+               block[key_eui_order], block['TotalTime'])
 
-    fdd = list(fddCursor)
+
+def _CollectPeaks(records, sensorType, track):
+    """
+    Collect the peak records in the DownloadPeakVector lists
+
+    :return: modalFreq, modalshape_cluster, trueListDate, shapeEuiOrderList, total_time_days
+    """
     modalFreq = []
     modalshape_cluster = []
     trueListDate = []
     shapeEuiOrderList = []
     total_time_days = []
 
-    #pdb.set_trace()
-    key_eui_order = "ShapeEUIorder" if sensorType==3 else "EUIorder"
+    for date, freqVector, modalshapeVector, euiOrder, totalTime in records:
+        trueListDate.append(date)
+        modalFreq.append(freqVector)
+        total_time_days.append(totalTime)
+        if sensorType==3:
+            modalshape_cluster.append(modalshapeVector)
+        if track:
+            shapeEuiOrderList.append(euiOrder)
 
-    if not track: #download only 14 days
+    return modalFreq, modalshape_cluster, trueListDate, shapeEuiOrderList, total_time_days
 
-        print(f"Downloading {axis} axis peaks from {local_or_prod} db ({initialization_days} days)")
-        giorno = 1
-        while (giorno <= initialization_days): 
-            #print(f" ****** [ giorno {giorno}] ******* AXIS {axis}")
-            sensorsEuis_new = fdd[giorno-1][key_eui_order]
-            if (num_sensori != np.shape(sensorsEuis_new)[0]):
-                giorno += 1
-                initialization_days += 1
-                continue
-
-            else:
-                trueListDate.append(fdd[giorno-1]['date'])
-                modalFreq.append(fdd[giorno-1]['freqVector'])
-                total_time_days.append(fdd[giorno-1]['TotalTime'])
-                if sensorType==3:
-                    modalshape_cluster.append(fdd[giorno-1]['modalshapeVector'])
-                giorno += 1
 
-    else:          #from day 15 onwards
+def _CustomerClient(dbClient, local):
+    """Client of the local db if local is True, otherwise dbClient (production)"""
+    return db_utils.MongoManager.getLocalInstance() if local else dbClient
 
-        print(f"Downloading {axis} axis peaks from {local_or_prod} db ({len(fdd)-initialization_days} days)")
-        giorno = initialization_days + 1
 
-        while giorno <= len(fdd):
-                trueListDate.append(fdd[giorno-1]['date'])
-                modalFreq.append(fdd[giorno-1]['freqVector'])
-                total_time_days.append(fdd[giorno-1]['TotalTime'])
-                if sensorType==3:
-                    modalshape_cluster.append(fdd[giorno-1]['modalshapeVector'])
-                shapeEuiOrderList.append(fdd[giorno-1][key_eui_order])
-                giorno += 1
+class FddSlice:
+    """
+    fdd documents of one (db, collection, structureID, group, sensorType, axis) slice, downloaded once
+
+    Traces, shapes, initialization traces and peak vectors are all derived from the same in-memory
+    documents, so an analysis needing several of them queries the collection only once:
 
-    return modalFreq, modalshape_cluster,trueListDate, shapeEuiOrderList, total_time_days, fdd[-1]['fSample'] if sensorType==3 else None
+        fdd = FddSlice(dbClient, 'deck_sveco', 'fdd_def', structureID, group, 3, 'X')
+        ftraces, giornitraces, fclustermodali = fdd.traces()
+        modalFreq, modalshape_cluster, trueListDate, _, _, fSample = fdd.peakVector(num_sensori, False, 14)
 
+    With a list of axes (sensorType 2 and 3) all of them are fetched with a single $in query,
+    and byAxis() splits the documents into one slice per axis.
 
+    The Download* functions of this module are thin views over it.
+    """
 
+    def __init__(self, db_client, db_name, coll_name, structureID, group, sensorType, axis=None, cache=None,
+                 typed=False, projection=None):
+        """
+        :param typed: always filter on the fdd type (_FddQuery does not for sensorType 1)
+        :param projection: fields to download when there is no cache, for slices used only by
+            the views needing them (e.g. traceSet)
+        """
+        self.coll = db_client[str(db_name)][coll_name]
+        self.sensorType = sensorType
+        self.axis = axis
+        self.query = _FddQuery(structureID, group, sensorType, axis)
+        if typed:
+            self.query["type"] = SWITCHER.get(sensorType)
+        self.cache = cache
+        self.projection = projection
+        self._docs = None
+
+    @property
+    def docs(self):
+        """fdd documents sorted by date (downloaded on first access)"""
+        if self._docs is None:
+            self._docs = _FetchFdd(self.coll, self.query, self.cache, self.projection)
+        return self._docs
+
+    def byAxis(self):
+        """
+        Split a multi-axis slice
+
+        :return: dict axis -> FddSlice of that axis, sharing the downloaded documents
+        """
+        axes = self.axis if _IsMultiAxis(self.axis) else [self.axis]
+        if self.sensorType in [2,3]:
+            split = _SplitByAxis(self.docs, axes)
+        else:
+            split = {ax: self.docs for ax in axes}  # no axis filter for these sensor types
+
+        slices = {}
+        for ax in axes:
+            fddAxis = copy.copy(self)
+            fddAxis.axis = ax
+            fddAxis.query = dict(self.query, axis=ax.upper()) if "axis" in self.query else self.query
+            fddAxis._docs = split[ax]
+            slices[ax] = fddAxis
+        return slices
+
+    def _typedDocs(self):
+        # the traces views always filter on type, a slice built with typed=False may not
+        if "type" in self.query:
+            return self.docs
+        fdd_type = SWITCHER.get(self.sensorType)
+        return [doc for doc in self.docs if doc.get("type") == fdd_type]
+
+    def traces(self):
+        """
+        :return: ftraces, giornitraces, fclustermodali (as DownloadTraces)
+        """
+        with metrics_utils.phase("regroup"):
+            ftraces, _, giornitraces = _GroupTraces(self._typedDocs(), self.sensorType, shapes=False)
+        with metrics_utils.phase("aggregate"):
+            fclustermodali = [np.mean(ftraces[key]) for key in ftraces.keys() if key !=-1]
+        return ftraces, giornitraces, fclustermodali
+
+    def tracesAndShapes(self):
+        """
+        :return: ftraces, giornitraces, modalshapetraces, fclustermodali, modalshapeclustermodali
+            (as DownloadTracesAndShapes)
+        """
+        with metrics_utils.phase("regroup"):
+            ftraces, modalshapetraces, giornitraces, shapeeuitraces = _GroupTraces(
+                self._typedDocs(), self.sensorType, shapes=True, euis=True)
+        with metrics_utils.phase("aggregate"):
+            fclustermodali = [np.mean(ftraces[key]) for key in ftraces.keys() if key !=-1]
+            modalshapeclustermodali = [_MeanShape(modalshapetraces[key], shapeeuitraces[key])
+                                       for key in ftraces.keys() if key!=-1]
+        return ftraces, giornitraces, modalshapetraces, fclustermodali, modalshapeclustermodali
+
+    def traceSet(self, shapes=False):
+        """Traces of the slice as a TraceSet"""
+        with metrics_utils.phase("regroup"):
+            return TraceSet.fromFdd(self._typedDocs(), shapes=shapes)
+
+    def initializationTraces(self, initialization_days, num_sensori):
+        """
+        :return: ftraces, modalshapetraces, giornitraces, fclustermodali, modalshapeclustermodali
+            (as DownloadInitializationTraces)
+        """
+        if initialization_days == False: #scarica tutta la serie di tracce
+            blocks = self.docs
+        else:
+            blocks = _InitializationBlocks(self.docs, self.sensorType, initialization_days, num_sensori)
+
+        with metrics_utils.phase("regroup"):
+            ftraces, modalshapetraces, giornitraces, shapeeuitraces = _GroupTraces(blocks, self.sensorType, euis=True)
+        with metrics_utils.phase("aggregate"):
+            fclustermodali, modalshapeclustermodali = _ClusterMeans(ftraces, modalshapetraces, self.sensorType,
+                                                                    shapeeuitraces)
+
+        return ftraces,modalshapetraces, giornitraces, fclustermodali, modalshapeclustermodali
+
+    def peakVector(self, num_sensori, track, initialization_days):
+        """
+        :return: modalFreq, modalshape_cluster, trueListDate, shapeEuiOrderList, total_time_days, fSample
+            (as DownloadPeakVector)
+        """
+        blocks = _PeakBlocks(self.docs, self.sensorType, num_sensori, track, initialization_days)
+        with metrics_utils.phase("regroup"):
+            peaks = _CollectPeaks(_PeakRecords(blocks, self.sensorType), self.sensorType, track)
+        fSample = self.docs[-1]['fSample'] if self.sensorType==3 else None
+        return (*peaks, fSample)
+
+
+def StreamPeakVector(db_client, db_name, structureID, group, sensorType, axis,
+            num_sensori, track, initialization_days, coll_name, batch_size=100, chunk_size=None):
+    """
+    Stream the freqVector and the modalShapeVector from a db without materializing the whole history
 
+    Yield (date, freqVector, modalshapeVector, EUIorder, TotalTime) records, or lists of chunk_size records.
+    When track is False the cursor is closed as soon as initialization_days valid blocks have been read,
+    when it is True the first initialization_days documents are skipped by the server.
 
-def DownloadInitializationTraces(dbClient, dbName, structureID, group, sensorType, axis, initialization_days, num_sensori, local_or_prod, coll_name):
+    :param batch_size: number of documents fetched from the server per round trip
+    :param chunk_size: if set, yield lists of records instead of single records
     """
-    Download traces (and their mean values) of a 14-day initialization period from any db 
-    (it can be used both for plotting purposes and to skip the init calculations)
+    fddCollection = db_client[str(db_name)][coll_name]
+    cursor = _PeakCursor(fddCollection, _FddQuery(structureID, group, sensorType, axis), PEAK_PROJECTION,
+                         track, initialization_days, batch_size)
+    try:
+        records = _PeakRecords(_PeakBlocks(cursor, sensorType, num_sensori, track, 0 if track else initialization_days),
+                               sensorType)
+        if not chunk_size:
+            yield from records
+            return
+        while True:
+            chunk = list(islice(records, chunk_size))
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        cursor.close()
+
+
+@metrics_utils.instrumented
+def DownloadPeakVector(dbClient, dbName, structureID, group, sensorType, axis,
+            num_sensori, track, initialization_days, local_or_prod, coll_name, cache=None,
+            stream=False, batch_size=100, output="lists", shape_store=None):
     """
-    switcher = {
-        1: "deck",
-        2: "accelerometerComplete",
-        3: "accelerometerComplete",
-        4: "deckShort1600"
-    }
-    
-    if local_or_prod=='local':
-        customerDb = dbClientLocal[str(dbName)]
-    else:
-        customerDb = dbClient[str(dbName)]  # db di produzione
-    
-    fddCollection = customerDb[coll_name]
+    Download the freqVector and the modalShapeVector from a db
 
-    if sensorType in [2,3]:
-        # breakpoint()
-        fddCursor = fddCollection.find({"structureID": ObjectId(structureID), "group": ObjectId(group) ,"type": switcher.get(sensorType), "axis": axis.upper()}).sort("date",1)
-    elif sensorType==4:
-        fddCursor = fddCollection.find({"structureID": ObjectId(structureID), "group": ObjectId(group) ,"type": switcher.get(sensorType)}).sort("date",1)
+    :param cache: optional cache_utils.FddCache, only the documents newer than the cached ones are downloaded
+    :param stream: if True read the cursor in batches of batch_size documents (only the needed fields),
+        stopping after the initialization days when track is False, instead of downloading the whole history
+    :param output: "lists" (lists of Python lists, as returned by pymongo) or "numpy": the arrays are read
+        straight from the raw BSON and modalFreq is a 2-D array padded with NaN, modalshape_cluster a
+        (values, row_offsets, day_offsets) ragged triple (see bson_utils.raggedShapes),
+        trueListDate a datetime64 array and total_time_days a float64 array
+    :param axis: a list of axes downloads all of them with one query and returns a dict axis -> outputs
+        (stream is ignored in this mode)
+    :param shape_store: optional shape_utils.ShapeStore of the group/axis (sensorType 3 only): it is updated
+        with the new days, the documents are read without modalshapeVector and modalshape_cluster is a
+        lazy, memory-mapped shape_utils.ShapeView of the selected days
+    """
+    # only 'prod' selects production here, any other value the local db
+    client = _CustomerClient(dbClient, local_or_prod!='prod')
+
+    if not track: #download only 14 days
+        metrics_utils.log(f"Downloading {axis} axis peaks from {local_or_prod} db ({initialization_days} days)")
+    else:          #from day 15 onwards
+        metrics_utils.log(f"Downloading {axis} axis peaks from {local_or_prod} db (from day {initialization_days + 1})")
+
+    if _IsMultiAxis(axis):
+        fdd = FddSlice(client, dbName, coll_name, structureID, group, sensorType, axis, cache=cache)
+        return {ax: _PeakOutput(fddAxis.peakVector(num_sensori, track, initialization_days), output)
+                for ax, fddAxis in fdd.byAxis().items()}
+
+    if shape_store is not None and sensorType==3:
+        fddCollection = client[str(dbName)][coll_name]
+        query = _FddQuery(structureID, group, sensorType, axis)
+        shape_store.update(fddCollection, query, batch_size=batch_size)
+
+        projection = {key: value for key, value in PEAK_PROJECTION.items() if key != "modalshapeVector"}
+        cursor = _PeakCursor(fddCollection, query, projection, track, initialization_days, batch_size)
+        try:
+            records = _PeakRecords(_PeakBlocks(cursor, sensorType, num_sensori, track, 0 if track else initialization_days),
+                                   sensorType, shapes=False)
+            with metrics_utils.phase("regroup"):
+                modalFreq, _, trueListDate, shapeEuiOrderList, total_time_days = _CollectPeaks(records, sensorType, track)
+        finally:
+            cursor.close()
+        metrics_utils.count(docs=len(trueListDate))
+        last = fddCollection.find_one(query, {"fSample": 1}, sort=[("date", -1)])
+        peaks = (modalFreq, shape_store.select(trueListDate), trueListDate, shapeEuiOrderList, total_time_days,
+                 last['fSample'] if last else None)
+    elif cache is not None or (not stream and output != "numpy"):
+        peaks = FddSlice(client, dbName, coll_name, structureID, group, sensorType, axis, cache=cache) \
+                    .peakVector(num_sensori, track, initialization_days)
     else:
-        fddCursor = fddCollection.find({"structureID": ObjectId(structureID), "group": ObjectId(group) }).sort("date",1)
-    fdd = list(fddCursor)
-
-    if initialization_days == False: #scarica tutta la serie di tracce
-
-        labels = []
-        # Cerco le label uniche
-        for tracesBlock in fdd:
-            for singleTrace in tracesBlock['traces']:
-                labels.append(singleTrace['label'])
-        # Inizializzo un array per label
-        ftraces = {k: [] for k in set(labels)}
-        modalshapetraces = {k: [] for k in set(labels)}
-        giornitraces = {k: [] for k in set(labels)}
-
- 
-        # Appendo tutti i valori label per label
-        for tracesBlock in fdd:
-            for singleTrace in tracesBlock['traces']:
-                ftraces[singleTrace['label']].append(singleTrace['freq_value'])
-                if sensorType==3:
-                    modalshapetraces[singleTrace['label']].append(singleTrace['shape_value'])
-                giornitraces[singleTrace['label']].append(tracesBlock['date'])
-
-        f1 = []
-        shape1 = []
+        fddCollection = client[str(dbName)][coll_name]
+        query = _FddQuery(structureID, group, sensorType, axis)
+        if output == "numpy":
+            rawCollection = fddCollection.with_options(codec_options=bson_utils.RAW_OPTIONS)
+            cursor = _PeakCursor(rawCollection, query, PEAK_PROJECTION, track, initialization_days, batch_size)
+            docs = (bson_utils.RawFdd(doc.raw) for doc in cursor)
+            records = _PeakRecords(_PeakBlocks(docs, sensorType, num_sensori, track, 0 if track else initialization_days),
+                                   sensorType)
+        else:
+            records = StreamPeakVector(client, dbName, structureID, group, sensorType, axis,
+                                       num_sensori, track, initialization_days, coll_name, batch_size=batch_size)
+        last = fddCollection.find_one(query, {"fSample": 1}, sort=[("date", -1)]) if sensorType==3 else None
 
-        if sensorType==3:
+        # this loop also pulls the documents from the server
+        with metrics_utils.phase("regroup"):
+            peaks = (*_CollectPeaks(records, sensorType, track), last['fSample'] if last else None)
+        metrics_utils.count(docs=len(peaks[2]))
 
-            for key in list(ftraces.keys()):
-                if (key != -1):
-                    media = np.mean(ftraces[key])
-                    f1.append(media)
-                    shapemedia = np.zeros(np.shape(modalshapetraces[key][0])[0])
-                    for m in range (np.shape(shapemedia)[0]):
-                        points = []
-                        for j in range(np.shape(ftraces[key])[0]):
-                            points.append(modalshapetraces[key][j][m])
-                        shapemedia[m] = np.mean(points)
-                    shape1.append(list(shapemedia))  
-            fclustermodali = f1
-            modalshapeclustermodali = shape1
+    return _PeakOutput(peaks, output)
 
+
+def _PeakOutput(peaks, output):
+    """DownloadPeakVector outputs, as lists or NumPy arrays"""
+    modalFreq, modalshape_cluster, trueListDate, shapeEuiOrderList, total_time_days, fSample = peaks
+
+    if output == "numpy":
+        modalFreq = _padShapes(modalFreq)[0]
+        if isinstance(modalshape_cluster, shape_utils.ShapeView):
+            modalshape_cluster = modalshape_cluster.ragged()
         else:
-            for key in list(ftraces.keys()):
-                if (key != -1):
-                    media = np.mean(ftraces[key])
-                    f1.append(media)
-            fclustermodali = f1
-            modalshapeclustermodali = None
-
-    else: #intialization_days != False
-
-        print(f"Downloading {axis} axis init traces from {local_or_prod} db")
-        key_eui_order = 'ShapeEUIorder' if sensorType==3 else 'EUIorder'
-        
-        fdd_initialization = []
-        giorno = 1
-        while (giorno <= initialization_days): 
-            #print(f" ****** [ giorno {giorno}] ******* TypeSensor {sensorType}, AXIS {axis}")
-            sensorsEuis_new = fdd[giorno-1][key_eui_order]
-
-            if (num_sensori != np.shape(sensorsEuis_new)[0]):
-                giorno = giorno + 1
-                initialization_days = initialization_days + 1
-                continue
-            else:
-                fdd_initialization.append(fdd[giorno-1])
-                giorno = giorno + 1
-
-            # Cerco le label uniche
-            labels = [singleTrace['label'] for tracesBlock in fdd_initialization for singleTrace in tracesBlock['traces']]
-            # Inizializzo un array per label
-            ftraces = {k: [] for k in set(labels)}
-            modalshapetraces = {k: [] for k in set(labels)}
-            giornitraces = {k: [] for k in set(labels)}
-    
-            
-            # Appendo tutti i valori label per label
-            for tracesBlock in fdd_initialization:
-                for singleTrace in tracesBlock['traces']:
-                    ftraces[singleTrace['label']].append(singleTrace['freq_value'])
-                    if sensorType==3:
-                        modalshapetraces[singleTrace['label']].append(singleTrace['shape_value'])
-                    giornitraces[singleTrace['label']].append(tracesBlock['date'])
-
-            f1 = []
-            shape1 = []
-            
-            if sensorType==3:
+            modalshape_cluster = bson_utils.raggedShapes(modalshape_cluster)
+        trueListDate = np.array(trueListDate, dtype='datetime64[ms]')
+        total_time_days = np.array(total_time_days, dtype=np.float64)
+
+    return modalFreq, modalshape_cluster,trueListDate, shapeEuiOrderList, total_time_days, fSample
 
-                for key in list(ftraces.keys()):
-                    if (key != -1):
-                        media = np.mean(ftraces[key])
-                        f1.append(media)  
-                        shapemedia = np.zeros(np.shape(modalshapetraces[key][0])[0])
-                        for m in range (np.shape(shapemedia)[0]):
-                            points = []
-                            for j in range(np.shape(ftraces[key])[0]):
-                                points.append(modalshapetraces[key][j][m])
-                            shapemedia[m] = np.mean(points)
-                        shape1.append(list(shapemedia))  
-                fclustermodali = f1
-                modalshapeclustermodali = shape1
-            
-            else:
-
-                for key in list(ftraces.keys()):
-                    if (key != -1):
-                        media = np.mean(ftraces[key])
-                        f1.append(media)  
-                        
-                fclustermodali = f1
-                modalshapeclustermodali = None
-
-    return ftraces,modalshapetraces, giornitraces, fclustermodali, modalshapeclustermodali
 
 if __name__=='__main__':
-    import pymongo
-    dbClientLocal = pymongo.MongoClient("127.0.0.1", 27017) 
+    dbClientLocal = db_utils.MongoManager.getLocalInstance()
 
     ftraces, giornitraces, fclustermodali = DownloadTraces(
         db_client=dbClientLocal,
@@ -0,0 +1,79 @@
+"""Module to render batches of figures to files without opening a browser."""
+
+import html
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+import plotly.offline
+
+import depuration
+import plotting_utils
+
+PLOTLYJS = "plotly.min.js"
+
+BUILDERS = {
+    "traces": plotting_utils.PlotTraces,
+    "temperatures": depuration.PlotTemperatures,
+}
+
+
+def _fileName(index, name, fmt):
+    # the job index keeps the names unique ("a/b" and "a:b" are both sanitized to "a_b")
+    ext = "html" if fmt in ("html", "standalone") else fmt
+    return f"{index:04d}_" + re.sub(r"[^\w.-]+", "_", name) + "." + ext
+
+
+def _renderJob(job):
+    """Build a figure and write it to disk (runs in a worker process)"""
+    index, name, kind, kwargs, out_dir, fmt = job
+    fig = BUILDERS[kind](**kwargs, show=False)
+    file_name = _fileName(index, name, fmt)
+    path = os.path.join(out_dir, file_name)
+    if fmt == "html":
+        # every page loads the plotly.js bundle written once in out_dir
+        fig.write_html(path, include_plotlyjs=PLOTLYJS, full_html=True)
+    elif fmt == "standalone":
+        fig.write_html(path, include_plotlyjs=True, full_html=True)
+    else:
+        # static images (png, svg, pdf, ...) need kaleido
+        fig.write_image(path)
+    return name, file_name
+
+
+def RenderReport(jobs, out_dir, fmt="html", max_workers=None, title="Tracking report"):
+    """
+    Render many figures to files on a process pool and write an index page linking them
+
+    :param jobs: list of (name, kind, kwargs) where kind is a key of BUILDERS ("traces" for
+        plotting_utils.PlotTraces, "temperatures" for depuration.PlotTemperatures) and kwargs its arguments
+    :param fmt: "html" (pages sharing one plotly.js bundle), "standalone" (self-contained html pages)
+        or an image format such as "png" or "svg"
+    :param max_workers: number of worker processes (default: number of cores)
+    :return: path of the index page (a job that fails is listed there with its error, the others are still rendered)
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    if fmt == "html":
+        with open(os.path.join(out_dir, PLOTLYJS), "w", encoding="utf-8") as f:
+            f.write(plotly.offline.get_plotlyjs())
+
+    tasks = [(index, name, kind, kwargs, out_dir, fmt) for index, (name, kind, kwargs) in enumerate(jobs)]
+    rendered = []
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [(task[1], executor.submit(_renderJob, task)) for task in tasks]
+        for name, future in futures:
+            try:
+                rendered.append(future.result() + (None,))
+            except Exception as e:
+                rendered.append((name, None, e))
+
+    links = "\n".join(
+        f'<li><a href="{html.escape(file_name)}">{html.escape(name)}</a></li>' if error is None
+        else f'<li>{html.escape(name)}: FAILED ({html.escape(repr(error))})</li>'
+        for name, file_name, error in rendered
+    )
+    index_path = os.path.join(out_dir, "index.html")
+    with open(index_path, "w", encoding="utf-8") as f:
+        f.write(f"<!DOCTYPE html>\n<html><head><meta charset=\"utf-8\"><title>{html.escape(title)}</title></head>\n"
+                f"<body><h1>{html.escape(title)}</h1>\n<ul>\n{links}\n</ul></body></html>\n")
+    return index_path
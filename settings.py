@@ -10,4 +10,17 @@ USERNAME_DB = os.getenv("USERNAME_DB")
 PWD_DB = os.getenv("PWD_DB")
 IP_EC2 = os.getenv("IP_EC2")
 SSH_PKEY = os.getenv("SSH_PKEY")
-REMOTE_BIND_ADDRESS = os.getenv("REMOTE_BIND_ADDRESS")
\ No newline at end of file
+REMOTE_BIND_ADDRESS = os.getenv("REMOTE_BIND_ADDRESS")
+CACHE_DIR = os.getenv("SHM_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "shm_utils"))
+CACHE_MAX_BYTES = int(os.getenv("SHM_CACHE_MAX_BYTES", 2 * 1024**3))
+
+# MongoClient options (empty = pymongo default)
+MONGO_LOCAL_URL = os.getenv("MONGO_LOCAL_URL", "mongodb://127.0.0.1:27017")
+MONGO_MAX_POOL_SIZE = os.getenv("MONGO_MAX_POOL_SIZE")
+MONGO_COMPRESSORS = os.getenv("MONGO_COMPRESSORS")  # e.g. "zstd,snappy,zlib"
+MONGO_TIMEOUT_MS = os.getenv("MONGO_TIMEOUT_MS")
+MONGO_READ_PREFERENCE = os.getenv("MONGO_READ_PREFERENCE")  # e.g. "secondaryPreferred"
+
+# ssh tunnel (LOCATION == "local")
+SSH_TUNNEL_PORT = os.getenv("SSH_TUNNEL_PORT")  # reuse a tunnel already listening on this port
+SSH_KEEPALIVE = float(os.getenv("SSH_KEEPALIVE", 30))
@@ -0,0 +1,248 @@
+"""Module with a memory-mapped on-disk store of the modalshapeVector histories."""
+
+import fcntl
+import json
+import os
+import re
+from contextlib import contextmanager
+
+import numpy as np
+
+import bson_utils
+import metrics_utils
+import settings
+
+# file name -> dtype of the store arrays
+FILES = {
+    "values": np.float64,  # all the shape components, day after day, row after row
+    "rows": np.int64,  # values[rows[r]:rows[r+1]] is the shape of row (frequency) r
+    "dates": np.int64,  # date of every day, ms since the epoch
+    "day_rows": np.int64,  # rows day_rows[d]:day_rows[d+1] belong to day d
+    "sensors": np.int32,  # number of sensors (ShapeEUIorder length) of every day
+}
+
+
+class ShapeView:
+    """
+    Lazy view of the modalshapeVector of some days of a ShapeStore
+
+    Nothing is read until a day is accessed; the values are pages of the memory-mapped file,
+    so processes reading the same store share one copy through the page cache.
+    """
+
+    def __init__(self, values, rows, day_rows, dates, sensors):
+        self.values = values
+        self.rows = rows
+        self.day_rows = day_rows  # (n_days, 2) first and last + 1 row of every day
+        self.dates = dates.astype('datetime64[ms]')
+        self.sensors = sensors
+
+    def __len__(self):
+        return self.day_rows.shape[0]
+
+    def __getitem__(self, i):
+        """modalshapeVector of the i-th day: list of 1-D float64 views, one per frequency"""
+        first, last = self.day_rows[i]
+        return [self.values[self.rows[r]:self.rows[r + 1]] for r in range(first, last)]
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def ragged(self):
+        """
+        The shapes as a (values, row_offsets, day_offsets) triple, see bson_utils.raggedShapes
+
+        values is a slice of the memory-mapped file when the days are contiguous in the store.
+        """
+        counts = self.day_rows[:, 1] - self.day_rows[:, 0]
+        day_offsets = np.zeros(len(self) + 1, dtype=np.int64)
+        np.cumsum(counts, out=day_offsets[1:])
+        if len(self) == 0:
+            return np.empty(0), np.zeros(1, dtype=np.int64), day_offsets
+
+        contiguous = np.all(self.day_rows[1:, 0] == self.day_rows[:-1, 1])
+        if contiguous:
+            first, last = self.day_rows[0, 0], self.day_rows[-1, 1]
+            row_offsets = self.rows[first:last + 1] - self.rows[first]
+            return self.values[self.rows[first]:self.rows[last]], row_offsets, day_offsets
+
+        row_ids = np.concatenate([np.arange(a, b) for a, b in self.day_rows])
+        lengths = self.rows[row_ids + 1] - self.rows[row_ids]
+        row_offsets = np.zeros(row_ids.shape[0] + 1, dtype=np.int64)
+        np.cumsum(lengths, out=row_offsets[1:])
+        values = np.concatenate([self.values[self.rows[r]:self.rows[r + 1]] for r in row_ids]) \
+            if row_ids.shape[0] else np.empty(0)
+        return values, row_offsets, day_offsets
+
+
+class ShapeStore:
+    """
+    Append-only store of the modalshapeVector history of one structure/group/axis.
+
+    Every array is a flat binary file read through np.memmap, plus a json file with the
+    number of valid items and the date watermark. update() downloads only the documents newer
+    than the watermark and appends them; bytes past the counts of the json file (an interrupted
+    append) are truncated before the next one. Writers take an exclusive lock on a lock file,
+    so concurrent updates (other threads or processes) run one after the other; readers do not lock.
+    """
+
+    def __init__(self, db_name, coll_name, structureID, group, axis, root=None):
+        name = re.sub(r"[^\w.-]+", "_", f"{db_name}_{coll_name}_{structureID}_{group}_{axis}")
+        self.path = os.path.join(root or os.path.join(settings.CACHE_DIR, "shapes"), name)
+        os.makedirs(self.path, exist_ok=True)
+        self.meta_path = os.path.join(self.path, "meta.json")
+        self.lock_path = os.path.join(self.path, "lock")
+
+    def _file(self, name):
+        return os.path.join(self.path, name + ".bin")
+
+    def meta(self) -> dict:
+        if not os.path.exists(self.meta_path):
+            return {"values": 0, "rows": 1, "dates": 0, "day_rows": 1, "sensors": 0, "watermark": None}
+        with open(self.meta_path) as f:
+            return json.load(f)
+
+    def _array(self, name, count):
+        if count == 0:
+            return np.empty(0, dtype=FILES[name])
+        return np.memmap(self._file(name), dtype=FILES[name], mode="r", shape=(count,))
+
+    def __len__(self):
+        return self.meta()["dates"]
+
+    def dates(self):
+        """Dates of the stored days (datetime64[ms])"""
+        return self._array("dates", self.meta()["dates"]).astype('datetime64[ms]')
+
+    @contextmanager
+    def _locked(self):
+        """Exclusive lock of the store for read meta/truncate/append/replace meta"""
+        with open(self.lock_path, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def append(self, days):
+        """
+        Append days to the store
+
+        :param days: iterable of (date, modalshapeVector, number of sensors), sorted by date and
+            newer than the stored ones
+        :return: number of appended days
+        """
+        with self._locked():
+            return self._append(days)
+
+    def _append(self, days):
+        meta = self.meta()
+        values, row_lengths, dates, day_counts, sensors = [], [], [], [], []
+        for date, shapes, n_sensors in days:
+            dates.append(np.datetime64(date, 'ms').astype(np.int64))
+            day_counts.append(len(shapes))
+            sensors.append(n_sensors)
+            for shape in shapes:
+                shape = np.asarray(shape, dtype=np.float64)
+                values.append(shape)
+                row_lengths.append(shape.shape[0])
+        if not dates:
+            return 0
+
+        new = {
+            "values": np.concatenate(values) if values else np.empty(0),
+            "rows": meta["values"] + np.cumsum(np.asarray(row_lengths, dtype=np.int64)),
+            "dates": np.asarray(dates, dtype=np.int64),
+            "day_rows": meta["rows"] - 1 + np.cumsum(np.asarray(day_counts, dtype=np.int64)),
+            "sensors": np.asarray(sensors, dtype=np.int32),
+        }
+        empty = meta["dates"] == 0
+        for name, dtype in FILES.items():
+            with open(self._file(name), "ab") as f:
+                # drop what an interrupted append left past the valid items
+                f.truncate(0 if empty else meta[name] * np.dtype(dtype).itemsize)
+                if empty and name in ("rows", "day_rows"):
+                    f.write(np.zeros(1, dtype=dtype).tobytes())  # leading offset
+                f.write(np.ascontiguousarray(new[name], dtype=dtype).tobytes())
+
+        meta = {name: meta[name] + new[name].shape[0] for name in FILES}
+        meta["watermark"] = int(new["dates"][-1])
+        tmp_path = self.meta_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, self.meta_path)
+        return len(dates)
+
+    def update(self, coll, query, batch_size=100, chunk_days=500):
+        """
+        Append the documents of coll matching query that are newer than the stored ones
+
+        The documents are read as raw BSON (only date, modalshapeVector and ShapeEUIorder) and decoded
+        straight into NumPy; at most chunk_days days are held in memory.
+
+        :param query: fdd query of the structure/group/axis (see plotting_utils._FddQuery)
+        :return: number of appended days
+        """
+        with self._locked():
+            # the watermark is read under the lock: another writer may have just moved it
+            return self._update(coll, query, batch_size, chunk_days)
+
+    def _update(self, coll, query, batch_size, chunk_days):
+        watermark = self.meta()["watermark"]
+        query = dict(query)
+        if watermark is not None:
+            query["date"] = {"$gt": np.datetime64(watermark, 'ms').astype(object)}
+        projection = {"_id": 0, "date": 1, "modalshapeVector": 1, "ShapeEUIorder": 1}
+        rawCollection = coll.with_options(codec_options=bson_utils.RAW_OPTIONS)
+
+        appended = 0
+        with metrics_utils.phase("query"):
+            cursor = rawCollection.find(query, projection).sort("date", 1).batch_size(batch_size)
+        try:
+            chunk = []
+            for raw in cursor:
+                doc = bson_utils.RawFdd(raw.raw)
+                chunk.append((doc["date"], doc["modalshapeVector"], len(doc.get("ShapeEUIorder") or [])))
+                if len(chunk) >= chunk_days:
+                    appended += self._append(chunk)
+                    chunk = []
+            appended += self._append(chunk)
+        finally:
+            cursor.close()
+        metrics_utils.count(docs=appended)
+        return appended
+
+    def _view(self, day_ids, meta):
+        rows = self._array("rows", meta["rows"])
+        day_rows = self._array("day_rows", meta["day_rows"])
+        return ShapeView(self._array("values", meta["values"]), rows,
+                         np.stack([day_rows[day_ids], day_rows[day_ids + 1]], axis=1).reshape(-1, 2),
+                         self._array("dates", meta["dates"])[day_ids], self._array("sensors", meta["sensors"])[day_ids])
+
+    def view(self, start=None, end=None):
+        """
+        Lazy view of the days between start (included) and end (excluded)
+
+        :param start, end: datetimes or datetime64, None for no limit
+        """
+        meta = self.meta()
+        dates = self._array("dates", meta["dates"])
+        first = 0 if start is None else int(np.searchsorted(dates, np.datetime64(start, 'ms').astype(np.int64)))
+        last = dates.shape[0] if end is None else int(np.searchsorted(dates, np.datetime64(end, 'ms').astype(np.int64)))
+        return self._view(np.arange(first, max(first, last)), meta)
+
+    def select(self, dates):
+        """
+        Lazy view of the given days (in the given order)
+
+        :raise KeyError: if a date is not in the store
+        """
+        meta = self.meta()
+        stored = self._array("dates", meta["dates"])
+        wanted = np.asarray(dates, dtype='datetime64[ms]').astype(np.int64)
+        pos = np.searchsorted(stored, wanted)
+        found = (pos < stored.shape[0]) & (stored[np.minimum(pos, max(stored.shape[0] - 1, 0))] == wanted) \
+            if stored.shape[0] else np.zeros(wanted.shape, bool)
+        if not np.all(found):
+            raise KeyError(f"{int((~found).sum())} dates are not in the shape store")
+        return self._view(pos, meta)
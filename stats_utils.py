@@ -0,0 +1,181 @@
+"""Module with per-label statistics of the frequency traces (envelopes, percentiles, drift)."""
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from traces_utils import toDays
+
+PERCENTILES = (5, 25, 50, 75, 95)
+
+
+def _Labels(ftraces, skip_outliers=True):
+    return [key for key in ftraces.keys() if not (skip_outliers and key == -1)]
+
+
+def _Pack(ftraces, giornitraces, labels):
+    """
+    Concatenate the traces of the given labels
+
+    :return: label index of every point, day numbers, frequencies
+    """
+    lengths = [len(ftraces[key]) for key in labels]
+    rows = np.repeat(np.arange(len(labels)), lengths)
+    freqs = np.concatenate([np.asarray(ftraces[key], dtype=np.float64) for key in labels]) if labels else np.empty(0)
+    days = np.concatenate([toDays(giornitraces[key]).astype(np.int64) for key in labels]) if labels else np.empty(0, dtype=np.int64)
+    return rows, days, freqs
+
+
+def RollingEnvelopes(ftraces, giornitraces, window=30, n_sigma=2.0, min_periods=3, center=False, alldays=None):
+    """
+    Rolling mean and standard deviation of every label on a daily grid, all labels at once
+
+    The points are binned per (label, day) with bincount and the window sums are differences
+    of cumulative sums, so the cost does not depend on the window length.
+
+    :param window: window length in days
+    :param n_sigma: half width of the envelope in standard deviations
+    :param min_periods: minimum number of points in the window (fewer gives NaN)
+    :param center: if True the window is centered on the day, otherwise it ends on the day
+    :param alldays: optional daily grid (default: every day from the first to the last trace date)
+    :return: alldays (datetime64[D] array), fcentrali, dftraces (dicts label -> array aligned with alldays),
+        ready for PlotTraces(boundaries=True)
+    """
+    labels = _Labels(ftraces)
+    rows, days, freqs = _Pack(ftraces, giornitraces, labels)
+
+    if alldays is None:
+        first, last = (days.min(), days.max()) if days.shape[0] else (0, -1)
+        grid = np.arange(first, last + 1, dtype=np.int64)
+    else:
+        grid = toDays(alldays).astype(np.int64)
+    n_labels, n_days = len(labels), grid.shape[0]
+
+    # points outside the grid are dropped
+    pos = np.searchsorted(grid, days)
+    inside = (pos < n_days) & (grid[np.minimum(pos, n_days - 1)] == days) if n_days else np.zeros(days.shape, bool)
+    rows, pos, freqs = rows[inside], pos[inside], freqs[inside]
+
+    # shift by the label mean so the sums of squares do not lose precision
+    counts_per_label = np.bincount(rows, minlength=n_labels)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        shift = np.bincount(rows, weights=freqs, minlength=n_labels) / counts_per_label
+    shift = np.nan_to_num(shift)
+    values = freqs - shift[rows]
+
+    flat = rows * n_days + pos
+    size = n_labels * n_days
+    cumulative = []
+    for weights in (None, values, values * values):
+        binned = np.bincount(flat, weights=weights, minlength=size).astype(np.float64).reshape(n_labels, n_days)
+        c = np.zeros((n_labels, n_days + 1))
+        np.cumsum(binned, axis=1, out=c[:, 1:])
+        cumulative.append(c)
+
+    j = np.arange(n_days)
+    if center:
+        start = np.clip(j - window // 2, 0, n_days)
+        end = np.clip(j + (window - 1) // 2 + 1, 0, n_days)
+    else:
+        start = np.clip(j - window + 1, 0, n_days)
+        end = j + 1
+    n, s, ss = (c[:, end] - c[:, start] for c in cumulative)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = s / n
+        var = np.maximum(ss - s * mean, 0.0) / (n - 1)
+    enough = n >= max(min_periods, 2)
+    mean = np.where(enough, mean + shift[:, None], np.nan)
+    std = np.where(enough, np.sqrt(var), np.nan)
+
+    fcentrali = {key: mean[i] for i, key in enumerate(labels)}
+    dftraces = {key: n_sigma * std[i] for i, key in enumerate(labels)}
+    return grid.astype('datetime64[D]'), fcentrali, dftraces
+
+
+def Percentiles(ftraces, q=PERCENTILES):
+    """
+    Percentiles of the frequency of every label
+
+    :return: dict label -> array with one value per q
+    """
+    labels = _Labels(ftraces)
+    lengths = np.array([len(ftraces[key]) for key in labels], dtype=np.int64)
+    if not labels or lengths.max() == 0:
+        return {key: np.full(len(q), np.nan) for key in labels}
+    # one NaN padded matrix, one nanpercentile call
+    padded = np.full((len(labels), lengths.max()), np.nan)
+    for i, key in enumerate(labels):
+        padded[i, :lengths[i]] = ftraces[key]
+    with np.errstate(invalid='ignore'):
+        values = np.nanpercentile(padded, q, axis=1).T if padded.shape[1] else np.full((len(labels), len(q)), np.nan)
+    return {key: values[i] for i, key in enumerate(labels)}
+
+
+def Drift(ftraces, giornitraces):
+    """
+    Linear drift of the frequency of every label
+
+    :return: dict label -> dict with slope [Hz/day], relative slope [1/year] (slope * 365 / mean frequency),
+        r (correlation of frequency and time) and n (number of points)
+    """
+    labels = _Labels(ftraces)
+    rows, days, freqs = _Pack(ftraces, giornitraces, labels)
+    n_labels = len(labels)
+    x = days.astype(np.float64)
+
+    n = np.bincount(rows, minlength=n_labels).astype(np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mx = np.bincount(rows, weights=x, minlength=n_labels) / n
+        my = np.bincount(rows, weights=freqs, minlength=n_labels) / n
+        dx = x - mx[rows]
+        dy = freqs - my[rows]
+        sxx = np.bincount(rows, weights=dx * dx, minlength=n_labels)
+        syy = np.bincount(rows, weights=dy * dy, minlength=n_labels)
+        sxy = np.bincount(rows, weights=dx * dy, minlength=n_labels)
+        slope = np.where(sxx > 0, sxy / sxx, np.nan)
+        r = np.where((sxx > 0) & (syy > 0), sxy / np.sqrt(sxx * syy), np.nan)
+        relative = slope * 365 / my
+
+    return {key: {"slope": slope[i], "relative": relative[i], "r": r[i], "n": int(n[i])}
+            for i, key in enumerate(labels)}
+
+
+def LabelStats(ftraces, giornitraces, window=30, n_sigma=2.0, min_periods=3, center=False, q=PERCENTILES):
+    """
+    All the statistics of one group
+
+    :return: dict with alldays, fcentrali, dftraces (see RollingEnvelopes), fclustermodali
+        (as DownloadTraces), percentiles (see Percentiles) and drift (see Drift)
+    """
+    alldays, fcentrali, dftraces = RollingEnvelopes(ftraces, giornitraces, window, n_sigma, min_periods, center)
+    return {
+        "alldays": alldays,
+        "fcentrali": fcentrali,
+        "dftraces": dftraces,
+        "fclustermodali": [np.mean(ftraces[key]) for key in ftraces.keys() if key != -1],
+        "percentiles": Percentiles(ftraces, q),
+        "drift": Drift(ftraces, giornitraces),
+    }
+
+
+def _labelStatsJob(job):
+    key, ftraces, giornitraces, kwargs = job
+    return key, LabelStats(ftraces, giornitraces, **kwargs)
+
+
+def FleetStats(traces, max_workers=None, **kwargs):
+    """
+    LabelStats of many groups, spread over a process pool
+
+    :param traces: dict key -> (ftraces, giornitraces) as returned by plotting_utils.DownloadTraces,
+        key is any picklable hashable (e.g. a fleet_utils.FleetTarget)
+    :param max_workers: number of worker processes (default: number of cores), 1 runs in this process
+    :param kwargs: arguments of LabelStats (window, n_sigma, min_periods, center, q)
+    :return: dict key -> LabelStats
+    """
+    jobs = [(key, ftraces, giornitraces, kwargs) for key, (ftraces, giornitraces) in traces.items()]
+    if max_workers == 1:
+        return dict(map(_labelStatsJob, jobs))
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return dict(executor.map(_labelStatsJob, jobs, chunksize=max(1, len(jobs) // 64)))
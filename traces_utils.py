@@ -0,0 +1,242 @@
+"""Module with a compact, array based container for fdd traces."""
+
+from datetime import date
+
+import numpy as np
+
+_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+
+class TraceSet:
+    """
+    Columnar container for the traces of a group.
+
+    Observations are stored sorted by label (and by date inside each label) in contiguous arrays:
+    float64 frequencies, datetime64 dates, int32 labels and an optional 2-D float array of
+    modal shapes (rows padded with NaN when the shape vectors have different lengths).
+    offsets[i]:offsets[i+1] is the slice of the i-th label, so per-label data are views.
+    """
+
+    def __init__(self, freqs, dates, labels, shapes=None, shape_lengths=None, label_order=None):
+        freqs = np.asarray(freqs, dtype=np.float64)
+        dates = np.asarray(dates, dtype='datetime64[ms]')
+        labels = np.asarray(labels, dtype=np.int32)
+
+        # stable sort keeps the date order inside each label
+        order = np.argsort(labels, kind='stable')
+        self.freqs = np.ascontiguousarray(freqs[order])
+        self.dates = np.ascontiguousarray(dates[order])
+        self.labels = np.ascontiguousarray(labels[order])
+        self.shapes = None if shapes is None else np.ascontiguousarray(np.asarray(shapes, dtype=np.float64)[order])
+        self.shape_lengths = None if shape_lengths is None else np.asarray(shape_lengths, dtype=np.int32)[order]
+
+        self.unique_labels, starts = np.unique(self.labels, return_index=True)
+        self.offsets = np.append(starts, self.labels.shape[0]).astype(np.int64)
+        self._index = {int(label): i for i, label in enumerate(self.unique_labels)}
+        # key order of the legacy dicts (they were built from a set of labels)
+        self.label_order = list(label_order) if label_order is not None else list(set(self._index))
+
+    @classmethod
+    def fromFdd(cls, fdd, shapes=False):
+        """Build a TraceSet from a list of fdd documents sorted by date"""
+        n = sum(len(trace_block['traces']) for trace_block in fdd)
+        freqs = np.empty(n, dtype=np.float64)
+        dates = np.empty(n, dtype='datetime64[ms]')
+        labels = np.empty(n, dtype=np.int32)
+        shape_values = []
+
+        i = 0
+        seen = {}
+        for trace_block in fdd:
+            date = np.datetime64(trace_block['date'], 'ms')
+            for trace in trace_block['traces']:
+                freqs[i] = trace['freq_value']
+                dates[i] = date
+                labels[i] = trace['label']
+                seen.setdefault(trace['label'], None)
+                if shapes:
+                    shape_values.append(trace['shape_value'])
+                i += 1
+
+        shape_array, shape_lengths = _padShapes(shape_values) if shapes else (None, None)
+        return cls(freqs, dates, labels, shape_array, shape_lengths, label_order=set(seen))
+
+    @classmethod
+    def fromDicts(cls, ftraces, giornitraces, modalshapetraces=None):
+        """Build a TraceSet from the legacy dict-of-lists outputs"""
+        freqs, dates, labels, shape_values = [], [], [], []
+        for key in ftraces.keys():
+            freqs.extend(ftraces[key])
+            dates.extend(giornitraces[key])
+            labels.extend([key] * len(ftraces[key]))
+            if modalshapetraces:
+                shape_values.extend(modalshapetraces[key])
+
+        shape_array, shape_lengths = _padShapes(shape_values) if modalshapetraces else (None, None)
+        return cls(freqs, dates, labels, shape_array, shape_lengths, label_order=ftraces.keys())
+
+    def __len__(self):
+        return self.freqs.shape[0]
+
+    def __contains__(self, label):
+        return label in self._index
+
+    def keys(self):
+        return list(self.label_order)
+
+    def _slice(self, label):
+        i = self._index[label]
+        return slice(self.offsets[i], self.offsets[i + 1])
+
+    def freq(self, label):
+        """Frequencies of a label (view)"""
+        return self.freqs[self._slice(label)]
+
+    def date(self, label):
+        """Dates of a label (view)"""
+        return self.dates[self._slice(label)]
+
+    def shape(self, label):
+        """Modal shapes of a label (view, rows padded with NaN)"""
+        if self.shapes is None:
+            return None
+        return self.shapes[self._slice(label)]
+
+    def shapeStats(self, label):
+        """Mean, std and MAC consistency of the modal shapes of a label (see modalShapeStats)"""
+        if self.shapes is None:
+            return None
+        return modalShapeStats(self.shape(label))
+
+    def mean(self):
+        """Mean frequency of every label, ordered as unique_labels"""
+        counts = np.diff(self.offsets)
+        if counts.shape[0] == 0:
+            return np.empty(0)
+        return np.add.reduceat(self.freqs, self.offsets[:-1]) / counts
+
+    def std(self):
+        """Standard deviation of the frequency of every label, ordered as unique_labels"""
+        counts = np.diff(self.offsets)
+        if counts.shape[0] == 0:
+            return np.empty(0)
+        means = np.repeat(self.mean(), counts)
+        return np.sqrt(np.add.reduceat((self.freqs - means) ** 2, self.offsets[:-1]) / counts)
+
+    def clusterMeans(self):
+        """Mean frequency of every label except outliers, in the same order as fclustermodali"""
+        means = self.mean()
+        return [means[self._index[key]] for key in self.label_order if key != -1]
+
+    def toDicts(self):
+        """
+        Convert to the legacy outputs
+
+        :return: ftraces, giornitraces, modalshapetraces (None if there are no shapes)
+        """
+        ftraces = {}
+        giornitraces = {}
+        modalshapetraces = {} if self.shapes is not None else None
+        for key in self.label_order:
+            sl = self._slice(key)
+            ftraces[key] = self.freqs[sl].tolist()
+            giornitraces[key] = self.dates[sl].astype(object).tolist()
+            if modalshapetraces is not None:
+                modalshapetraces[key] = [row[:n].tolist() for row, n in zip(self.shapes[sl], self.shape_lengths[sl])]
+        return ftraces, giornitraces, modalshapetraces
+
+
+def toDays(dates):
+    """datetime64[D] array of a list of datetimes (or of a datetime64 array)"""
+    if isinstance(dates, np.ndarray):
+        return dates.astype('datetime64[D]')
+    # much faster than letting NumPy convert the datetime objects one by one
+    ordinals = np.fromiter((d.toordinal() for d in dates), dtype=np.int64, count=len(dates))
+    return (ordinals - _EPOCH_ORDINAL).astype('datetime64[D]')
+
+
+def _padShapes(shape_values):
+    """
+    Stack vectors (shapes, freqVectors) of possibly different lengths
+
+    :return: 2-D float64 array padded with NaN, int32 array with the length of every row
+    """
+    lengths = np.fromiter((len(s) for s in shape_values), dtype=np.int32, count=len(shape_values))
+    width = int(lengths.max()) if lengths.shape[0] else 0
+    out = np.full((len(shape_values), width), np.nan)
+    for i, s in enumerate(shape_values):
+        out[i, :lengths[i]] = s
+    return out, lengths
+
+
+def alignShapes(shape_values, eui_orders):
+    """
+    Align shape vectors on their EUIs
+
+    Every shape vector must have one component per EUI of the corresponding ShapeEUIorder.
+    Columns follow the longest EUI order (the most recent one among those of the same length),
+    so a sensor missing on the first days does not permute them; EUIs not in it follow, in order
+    of first appearance. Missing sensors are NaN.
+
+    :return: 2-D array of shapes, list of EUIs of the columns
+    """
+    eui_orders = list(eui_orders)
+    columns = {}
+    longest = max(reversed(eui_orders), key=len, default=[])
+    for order in [longest] + eui_orders:
+        for eui in order:
+            columns.setdefault(eui, len(columns))
+
+    out = np.full((len(shape_values), len(columns)), np.nan)
+    for i, (s, order) in enumerate(zip(shape_values, eui_orders)):
+        if len(s) != len(order):
+            raise ValueError(f"Shape vector {i} has {len(s)} components but {len(order)} EUIs")
+        out[i, [columns[eui] for eui in order]] = s
+    return out, list(columns)
+
+
+def modalShapeStats(shapes, eui_orders=None):
+    """
+    Statistics of a set of modal shapes
+
+    :param shapes: 2-D array (observations x components, NaN where a component is missing)
+        or a list of shape vectors, possibly of different lengths
+    :param eui_orders: optional ShapeEUIorder of every shape vector: the components are aligned
+        on the EUIs (see alignShapes) instead of on their position, so a missing sensor does not
+        shift the following ones
+    :return: mean shape, std of every component, MAC of every observation with the mean shape
+        (computed on the components the observation has)
+    """
+    if eui_orders is not None:
+        values, _ = alignShapes(shapes, eui_orders)
+    elif isinstance(shapes, np.ndarray) and shapes.ndim == 2:
+        values = shapes.astype(np.float64, copy=False)
+    else:
+        values, _ = _padShapes(shapes)
+
+    mask = ~np.isnan(values)
+    count = mask.sum(axis=0)
+    filled = np.where(mask, values, 0.0)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # sums over contiguous rows, i.e. the same summation as np.mean on every component
+        mean = np.ascontiguousarray(filled.T).sum(axis=1) / count
+        dev = np.where(mask, values - mean, 0.0)
+        std = np.sqrt(np.ascontiguousarray((dev ** 2).T).sum(axis=1) / count)
+
+        mean_filled = np.where(mask, mean, 0.0)
+        cross = np.sum(filled * mean_filled, axis=1)
+        mac = cross ** 2 / (np.sum(filled ** 2, axis=1) * np.sum(mean_filled ** 2, axis=1))
+
+    return mean, std, mac
+
+
+def modalShapeStatsByLabel(modalshapetraces, shapeeuitraces=None):
+    """
+    Apply modalShapeStats to every label of a modalshapetraces dict (outliers excluded)
+
+    :param shapeeuitraces: optional dict label -> ShapeEUIorder of every shape, to align the shapes on the EUIs
+    :return: dict label -> (mean, std, mac)
+    """
+    return {key: modalShapeStats(shapes, shapeeuitraces[key] if shapeeuitraces else None)
+            for key, shapes in modalshapetraces.items() if key != -1 and len(shapes)}